@@ -1,7 +1,9 @@
 # backend/app.py
 
 import os
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file
+from werkzeug.utils import safe_join, secure_filename
+from urllib.parse import quote
 from flask_cors import CORS
 import pandas as pd
 from dotenv import load_dotenv
@@ -10,11 +12,35 @@ import logging
 import io
 import sys
 import json
+import csv
+import zlib
 import numpy as np
 import re
 import datetime
+import time
+import hashlib
+import sqlite3
+import threading
+import uuid
+import unicodedata
+import copy
+import shutil
+import contextvars
+from contextlib import contextmanager
+import itertools
+import queue
+import multiprocessing
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from openpyxl import load_workbook, Workbook # Import Workbook for new sheets
 
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError: # Session sheets are cached as pickles without pyarrow
+    pa = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -28,6 +54,53 @@ else:
     logging.getLogger('google.generativeai').propagate = False
     genai.configure(api_key=API_KEY)
 
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+
+# --- Chunked Processing Configuration ---
+# Large sheets are split into row chunks that are sent to Gemini concurrently
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "60000"))  # Approximate data tokens per chunk prompt
+CHUNK_MAX_WORKERS = int(os.getenv("CHUNK_MAX_WORKERS", "8"))  # Max concurrent Gemini calls per request
+CHUNK_MAX_RETRIES = int(os.getenv("CHUNK_MAX_RETRIES", "2"))  # Extra attempts for a failed chunk
+CHUNK_RETRY_BACKOFF_SECONDS = 1.0
+
+# --- Prompt Encoding Configuration ---
+# Sheet data is embedded in prompts as CSV or as compact row-numbered lines, optionally with repeated values dictionary-encoded
+PROMPT_ENCODING = os.getenv("PROMPT_ENCODING", "auto")  # "auto" picks the encoding with the fewest estimated tokens, or force "csv", "numbered" or "dictionary"
+PROMPT_FLOAT_SIGNIFICANT_DIGITS = int(os.getenv("PROMPT_FLOAT_SIGNIFICANT_DIGITS", "15"))  # Decimal numbers are trimmed to this precision in compact encodings (15 = Excel's own precision, which only drops float noise)
+PROMPT_DICTIONARY_MIN_LENGTH = 8  # Shorter repeated values are not worth a legend entry
+
+# --- Response Cache Configuration ---
+# Gemini responses are cached on disk, keyed by model name and prompt (projected data + command)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))  # Entries expire after a week
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # Least recently used entries are evicted above this size
+
+# --- Streaming Read Configuration ---
+# New-column jobs on large .xlsx sheets are streamed in row batches instead of loading the whole sheet
+STREAMING_ROW_THRESHOLD = int(os.getenv("STREAMING_ROW_THRESHOLD", "50000"))  # Sheets with more data rows are streamed
+STREAMING_BATCH_ROWS = int(os.getenv("STREAMING_BATCH_ROWS", "5000"))  # Rows read from the workbook per batch
+
+# --- Job Configuration ---
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "4"))  # Worker processes running queued jobs
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))  # How often each server records that it is alive
+JOB_SERVER_TIMEOUT_SECONDS = 3 * JOB_HEARTBEAT_SECONDS  # Jobs of servers silent for longer are taken over by a live server
+
+# --- Batch Configuration ---
+# Batch runs apply one command to many sheets and workbooks
+BATCH_PROCESS_WORKERS = int(os.getenv("BATCH_PROCESS_WORKERS", str(os.cpu_count() or 2)))  # Worker processes reading and writing workbooks
+BATCH_AI_WORKERS = int(os.getenv("BATCH_AI_WORKERS", "4"))  # Sheets whose AI commands run concurrently
+
+# --- Storage Configuration ---
+# Every request works in its own directory under UPLOAD_FOLDER / DOWNLOAD_FOLDER; a background janitor keeps disk use bounded
+STORAGE_MAX_AGE_SECONDS = int(os.getenv("STORAGE_MAX_AGE_SECONDS", str(24 * 3600)))  # Request directories older than this are removed
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", str(5 * 1024 * 1024 * 1024)))  # Oldest request directories are removed above this total size
+STORAGE_MIN_AGE_SECONDS = 15 * 60  # Newer request directories may still be in use and are never removed for size
+JANITOR_INTERVAL_SECONDS = int(os.getenv("JANITOR_INTERVAL_SECONDS", "300"))
+
+# --- Session Configuration ---
+# Workbooks uploaded once through /sessions are reused by later commands, with their parsed sheets cached on disk
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))  # Least recently used sessions are evicted above this size
+
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -37,25 +110,486 @@ CORS(app) # Enable CORS for frontend communication
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 DOWNLOAD_FOLDER = os.path.join(BASE_DIR, 'downloads')
+CACHE_FOLDER = os.path.join(BASE_DIR, 'cache')
+SESSION_FOLDER = os.path.join(BASE_DIR, 'sessions')
+JOBS_DB_PATH = os.path.join(BASE_DIR, 'jobs.sqlite3')
 
 # Create folders if they don't exist
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
+if not os.path.exists(CACHE_FOLDER):
+    os.makedirs(CACHE_FOLDER)
+if not os.path.exists(SESSION_FOLDER):
+    os.makedirs(SESSION_FOLDER)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limit max file size to 16MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "16")) * 1024 * 1024  # Limit max file size (16MB by default; writing results still loads the whole workbook)
 
 # Allowed file extensions for Excel files
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 
+class ResponseCache:
+    """
+    Persistent on-disk cache for Gemini responses, stored in SQLite.
+    Entries expire after a TTL, and the least recently used entries are evicted once the total size exceeds a cap.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int, max_bytes: int):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+
+    def _connect(self):
+        # A new connection per call keeps the cache safe to use from worker threads and processes
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _count(self, stat: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str) -> str:
+        """Content-addressed key: the prompt embeds the projected data payload and the user command."""
+        return hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached response for a key, or None on a miss or an expired entry."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._count("evictions")
+                self._count("misses")
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return row[0]
+
+    def put(self, key: str, response_text: str):
+        """Stores a response and evicts expired and least recently used entries if needed."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response_text, len(response_text.encode('utf-8')), now, now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now: float):
+        evicted = conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_bytes > self.max_bytes:
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+                if total_bytes <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total_bytes -= size
+                evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters for this process together with the current cache size."""
+        with self._connect() as conn:
+            entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "total_bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+        })
+        return stats
+
+
+response_cache = ResponseCache(os.path.join(CACHE_FOLDER, 'responses.sqlite3'), RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_BYTES)
+
+
+# --- Instrumentation ---
+# Pipeline stages are timed with stage_span(). Each span records its duration and the peak resident memory
+# sampled while it was open, both into the process-wide registry (exported by /metrics) and into the
+# PipelineMetrics of the current run (returned as a per-request "timings" breakdown).
+
+STAGE_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+MEMORY_SAMPLE_INTERVAL_SECONDS = 0.02
+
+
+def current_rss_bytes() -> int:
+    """Returns the resident memory of this process in bytes (falls back to the peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+        except ImportError: # Windows
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemorySampler:
+    """Background thread that samples the process RSS and tracks the peak seen while each stage span is open."""
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._open_spans = {}
+        self._span_ids = itertools.count()
+        self._thread = None
+
+    def start_span(self) -> int:
+        span_id = next(self._span_ids)
+        rss = current_rss_bytes()
+        with self._lock:
+            self._open_spans[span_id] = rss
+            # Threads do not survive a fork, so worker processes start their own sampler
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+                self._thread.start()
+        return span_id
+
+    def end_span(self, span_id: int) -> int:
+        rss = current_rss_bytes()
+        with self._lock:
+            return max(self._open_spans.pop(span_id, 0), rss)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            with self._lock:
+                if not self._open_spans:
+                    continue
+                rss = current_rss_bytes()
+                for span_id, peak in self._open_spans.items():
+                    if rss > peak:
+                        self._open_spans[span_id] = rss
+
+
+class PipelineMetrics:
+    """Stage timings, peak memory and token counts of a single pipeline run."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.ai_calls = 0
+
+    def add_stage(self, stage: str, seconds: float, peak_rss_bytes: int):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0, "peak_rss_mb": 0.0})
+            totals["seconds"] += seconds
+            totals["count"] += 1
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], round(peak_rss_bytes / (1024 * 1024), 1))
+
+    def add_tokens(self, prompt_tokens: int, response_tokens: int):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.response_tokens += response_tokens
+            self.ai_calls += 1
+
+    def summary(self) -> dict:
+        """Per-request timing breakdown. Stages that ran concurrently (e.g. chunk calls) report their summed time."""
+        with self._lock:
+            stages = {stage: {**totals, "seconds": round(totals["seconds"], 4)} for stage, totals in self.stages.items()}
+            return {
+                "total_seconds": round(time.perf_counter() - self.started, 4),
+                "stages": stages,
+                "prompt_tokens": self.prompt_tokens,
+                "response_tokens": self.response_tokens,
+                "ai_calls": self.ai_calls,
+            }
+
+
+class MetricsRegistry:
+    """Process-wide counters and histograms, rendered in the Prometheus text exposition format."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.stage_buckets = {}
+        self.stage_sums = {}
+        self.stage_counts = {}
+        self.stage_peak_rss = {}
+        self.tokens = {"prompt": 0, "response": 0}
+        self.ai_calls = 0
+        self.pipeline_runs = {}
+
+    def observe_stage(self, stage: str, seconds: float, peak_rss_bytes: int):
+        with self._lock:
+            counts = self.stage_buckets.setdefault(stage, [0] * len(self.buckets))
+            for i, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    counts[i] += 1
+            self.stage_sums[stage] = self.stage_sums.get(stage, 0.0) + seconds
+            self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+            self.stage_peak_rss[stage] = max(self.stage_peak_rss.get(stage, 0), peak_rss_bytes)
+
+    def add_tokens(self, prompt_tokens: int, response_tokens: int):
+        with self._lock:
+            self.tokens["prompt"] += prompt_tokens
+            self.tokens["response"] += response_tokens
+            self.ai_calls += 1
+
+    def observe_run(self, output_mode: str, status: str):
+        with self._lock:
+            key = (output_mode, status)
+            self.pipeline_runs[key] = self.pipeline_runs.get(key, 0) + 1
+
+    @staticmethod
+    def _label(value) -> str:
+        """Escapes a label value for the Prometheus text format."""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self) -> str:
+        label = self._label
+        lines = [
+            "# HELP xcelerate_stage_duration_seconds Time spent in each pipeline stage.",
+            "# TYPE xcelerate_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self.stage_counts):
+                for upper_bound, count in zip(self.buckets, self.stage_buckets[stage]):
+                    lines.append(f'xcelerate_stage_duration_seconds_bucket{{stage="{label(stage)}",le="{upper_bound}"}} {count}')
+                lines.append(f'xcelerate_stage_duration_seconds_bucket{{stage="{label(stage)}",le="+Inf"}} {self.stage_counts[stage]}')
+                lines.append(f'xcelerate_stage_duration_seconds_sum{{stage="{label(stage)}"}} {self.stage_sums[stage]:.6f}')
+                lines.append(f'xcelerate_stage_duration_seconds_count{{stage="{label(stage)}"}} {self.stage_counts[stage]}')
+
+            lines += ["# HELP xcelerate_stage_peak_rss_bytes Highest resident memory sampled during each pipeline stage.",
+                      "# TYPE xcelerate_stage_peak_rss_bytes gauge"]
+            lines += [f'xcelerate_stage_peak_rss_bytes{{stage="{label(stage)}"}} {peak}' for stage, peak in sorted(self.stage_peak_rss.items())]
+
+            lines += ["# HELP xcelerate_ai_tokens_total Gemini tokens used, by direction.",
+                      "# TYPE xcelerate_ai_tokens_total counter"]
+            lines += [f'xcelerate_ai_tokens_total{{direction="{direction}"}} {count}' for direction, count in self.tokens.items()]
+
+            lines += ["# HELP xcelerate_ai_calls_total Gemini API calls made (cache hits excluded).",
+                      "# TYPE xcelerate_ai_calls_total counter",
+                      f"xcelerate_ai_calls_total {self.ai_calls}"]
+
+            lines += ["# HELP xcelerate_pipeline_runs_total Completed pipeline runs, by output mode and status.",
+                      "# TYPE xcelerate_pipeline_runs_total counter"]
+            lines += [f'xcelerate_pipeline_runs_total{{output_mode="{label(mode)}",status="{label(status)}"}} {count}'
+                      for (mode, status), count in sorted(self.pipeline_runs.items())]
+
+        cache_stats = response_cache.stats()
+        lines += ["# HELP xcelerate_response_cache_lookups_total Response cache lookups, by result.",
+                  "# TYPE xcelerate_response_cache_lookups_total counter",
+                  f'xcelerate_response_cache_lookups_total{{result="hit"}} {cache_stats["hits"]}',
+                  f'xcelerate_response_cache_lookups_total{{result="miss"}} {cache_stats["misses"]}',
+                  "# HELP xcelerate_response_cache_bytes Size of the response cache.",
+                  "# TYPE xcelerate_response_cache_bytes gauge",
+                  f"xcelerate_response_cache_bytes {cache_stats['total_bytes']}",
+                  "# HELP xcelerate_process_resident_memory_bytes Current resident memory of the backend process.",
+                  "# TYPE xcelerate_process_resident_memory_bytes gauge",
+                  f"xcelerate_process_resident_memory_bytes {current_rss_bytes()}"]
+        return "\n".join(lines) + "\n"
+
+
+memory_sampler = MemorySampler(MEMORY_SAMPLE_INTERVAL_SECONDS)
+metrics_registry = MetricsRegistry(STAGE_DURATION_BUCKETS)
+# Metrics of the pipeline run in progress; chunk worker threads receive it through copied contexts
+current_pipeline_metrics = contextvars.ContextVar('current_pipeline_metrics', default=None)
+
+
+@contextmanager
+def stage_span(stage: str):
+    """Times a pipeline stage and samples its peak memory."""
+    span_id = memory_sampler.start_span()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        peak_rss_bytes = memory_sampler.end_span(span_id)
+        metrics_registry.observe_stage(stage, seconds, peak_rss_bytes)
+        pipeline_metrics = current_pipeline_metrics.get()
+        if pipeline_metrics is not None:
+            pipeline_metrics.add_stage(stage, seconds, peak_rss_bytes)
+
+
+@contextmanager
+def track_pipeline_run(output_mode: str):
+    """Collects PipelineMetrics for one pipeline run and counts the run by output mode and outcome."""
+    pipeline_metrics = PipelineMetrics()
+    token = current_pipeline_metrics.set(pipeline_metrics)
+    try:
+        yield pipeline_metrics
+        metrics_registry.observe_run(output_mode, "success")
+    except Exception:
+        metrics_registry.observe_run(output_mode, "error")
+        raise
+    finally:
+        current_pipeline_metrics.reset(token)
+
+
+def record_token_usage(response, prompt: str, response_text: str | None):
+    """Records the token counts of a Gemini call, estimating them if the response carries no usage metadata."""
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or estimate_tokens(prompt)
+    response_tokens = getattr(usage, 'candidates_token_count', 0) or (estimate_tokens(response_text) if response_text else 0)
+    metrics_registry.add_tokens(prompt_tokens, response_tokens)
+    pipeline_metrics = current_pipeline_metrics.get()
+    if pipeline_metrics is not None:
+        pipeline_metrics.add_tokens(prompt_tokens, response_tokens)
+
+
+# --- Request Working Directories ---
+# Each upload is saved to UPLOAD_FOLDER/<request id>/ under a sanitized name, and its results go to the same file or to
+# DOWNLOAD_FOLDER/<request id>/, so concurrent requests for equally named files never touch each other's files.
+# Files are written to a temporary name and renamed into place, so a download never sees a partially written workbook.
+# A background janitor removes request directories by age and total size.
+
+REQUEST_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def create_request_dir(parent_folder: str, request_id: str | None = None) -> str:
+    """Creates the working directory of a request (a new one unless request_id is given) and returns its path."""
+    request_dir = os.path.join(parent_folder, request_id or uuid.uuid4().hex)
+    os.makedirs(request_dir, exist_ok=True)
+    return request_dir
+
+
+def safe_upload_filename(filename: str) -> str:
+    """Sanitizes an uploaded file name for the filesystem, keeping its Excel extension (e.g. '../Q1 report.xlsx' -> 'Q1_report.xlsx')."""
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'xlsx'
+    safe_name = secure_filename(filename)
+    if not safe_name.lower().endswith(f".{extension}") or safe_name.lower() == extension:
+        safe_name = f"workbook.{extension}" # Nothing usable left, e.g. for names in non-Latin scripts
+    return safe_name
+
+
+@contextmanager
+def atomic_write_path(path: str):
+    """Yields a temporary path next to path (with the same extension); once the block succeeds, it is renamed to path in one step."""
+    directory, filename = os.path.split(path)
+    temp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex[:8]}-{filename}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def build_download_url(host_url: str, filepath: str) -> str:
+    """Returns the download URL of a file in a request directory of UPLOAD_FOLDER (/download/...) or DOWNLOAD_FOLDER (/download_new/...)."""
+    request_dir, filename = os.path.split(filepath)
+    route = 'download' if os.path.dirname(request_dir) == app.config['UPLOAD_FOLDER'] else 'download_new'
+    return f"{host_url}/{route}/{os.path.basename(request_dir)}/{quote(filename)}"
+
+
+def clean_request_storage() -> int:
+    """
+    Removes entries of UPLOAD_FOLDER and DOWNLOAD_FOLDER older than STORAGE_MAX_AGE_SECONDS, then the oldest remaining ones
+    (never those younger than STORAGE_MIN_AGE_SECONDS) until their total size fits STORAGE_MAX_BYTES. Returns the bytes freed.
+    """
+    now = time.time()
+    entries = []
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER']):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                is_dir = os.path.isdir(path)
+                entries.append((os.path.getmtime(path), path, is_dir, folder_size_bytes(path) if is_dir else os.path.getsize(path)))
+            except OSError: # Removed concurrently
+                continue
+    total_bytes = sum(size for _, _, _, size in entries)
+
+    freed_bytes = 0
+    for modified_at, path, is_dir, size in sorted(entries):
+        age_seconds = now - modified_at
+        if age_seconds > STORAGE_MAX_AGE_SECONDS or (total_bytes > STORAGE_MAX_BYTES and age_seconds > STORAGE_MIN_AGE_SECONDS):
+            try:
+                if is_dir:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                print(f"WARNING: Janitor could not remove {path}: {e}")
+                continue
+            total_bytes -= size
+            freed_bytes += size
+            print(f"DEBUG: Janitor removed {path} ({size} bytes, {age_seconds / 3600:.1f} hours old).")
+    return freed_bytes
+
+
+def is_main_process() -> bool:
+    """True in the server process itself, False in pool workers (including spawned workers while they re-import this module)."""
+    return multiprocessing.current_process().name == "MainProcess"
+
+
+_janitor_thread = None
+
+
+def start_storage_janitor():
+    """Starts the background thread that runs clean_request_storage every JANITOR_INTERVAL_SECONDS (in the main process only)."""
+    global _janitor_thread
+    if _janitor_thread is not None or not is_main_process():
+        return
+
+    def run_janitor():
+        while True:
+            try:
+                clean_request_storage()
+            except Exception as e:
+                print(f"ERROR: Storage janitor failed: {e}")
+            time.sleep(JANITOR_INTERVAL_SECONDS)
+
+    _janitor_thread = threading.Thread(target=run_janitor, name="storage-janitor", daemon=True)
+    _janitor_thread.start()
+
+
 def allowed_file(filename):
     """Checks if the uploaded file has an allowed extension."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+# --- AI Response Parsing ---
+# Only lines starting with a Markdown list marker ("*") are kept, so explanatory lines (e.g. "Here is the list:")
+# are dropped without scanning them for keywords. Patterns are compiled once and applied per kept line.
+LIST_ITEM_PAREN_COUNT_PATTERN = re.compile(r'\s*\(\d+\)$')  # Parenthesized data after company names (e.g., (4453))
+LIST_ITEM_NUMBERING_PATTERN = re.compile(r'^\d+\.?\s*\)?\s*')  # Numbering such as "1. Item" or "2) Item"
+
+
+def parse_ai_response_lines(lines):
+    """Yields the cleaned item of every Markdown list line ("* item") among the given lines."""
+    strip_paren_count = LIST_ITEM_PAREN_COUNT_PATTERN.sub
+    strip_numbering = LIST_ITEM_NUMBERING_PATTERN.sub
+    for line in lines:
+        stripped_line = line.strip()
+        if not stripped_line.startswith('*'):
+            continue
+        # Remove the list marker and potential bold formatting (**)
+        item = stripped_line[1:].strip().strip('*')
+        if not item:
+            continue
+        item = strip_paren_count('', item).strip()
+        item = strip_numbering('', item).strip()
+        if item:
+            yield item
+
+
 # Core change: parse_ai_response_to_list now strictly parses Markdown lists
 # AI will always return Markdown lists, so this function no longer needs to check is_markdown_list_expected
 def parse_ai_response_to_list(ai_response_text: str) -> list:
@@ -63,88 +597,258 @@ def parse_ai_response_to_list(ai_response_text: str) -> list:
     Parses AI text response to strictly extract items from a Markdown list.
     This version aims to precisely extract list content, filtering out any explanatory text or unrelated symbols.
     """
-    lines = ai_response_text.split('\n')
-    parsed_items = []
+    return list(parse_ai_response_lines(ai_response_text.split('\n')))
 
-    # Define common explanatory or non-content line starting keywords
-    filter_keywords = [
-        "response:", "here is", "list below", "results:", "pure result list",
-        "could not generate a valid response", "no valid command", "error", "hint", "summary",
-        "this is about", "here's what you asked for", "based on your command", "okay", "please refer",
-        "provided for you below", "here is the de-duplicated list", "these are the extracted company names",
-        "here are the differences", "difference list below",
-        "hello", "this is your", "as per your request", "certainly" # Added more general opening phrases
-    ]
 
-    for line in lines:
-        stripped_line = line.strip()
-        if not stripped_line: # Ignore empty lines
+def iter_parse_ai_response(text_chunks):
+    """
+    Incrementally parses a streamed AI response, yielding list items as soon as each complete line has arrived.
+    Produces the same items as parse_ai_response_to_list on the joined text.
+    """
+    pending_pieces = []
+    for text_chunk in text_chunks:
+        if '\n' not in text_chunk:
+            pending_pieces.append(text_chunk)
             continue
+        lines = text_chunk.split('\n')
+        if pending_pieces:
+            pending_pieces.append(lines[0])
+            lines[0] = "".join(pending_pieces)
+        pending_pieces = [lines.pop()]
+        yield from parse_ai_response_lines(lines)
+    if pending_pieces:
+        yield from parse_ai_response_lines(["".join(pending_pieces)])
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimates the token count of a text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def excel_column_letter(index: int) -> str:
+    """Converts a zero-based column index to its Excel column letter (0 -> 'A', 26 -> 'AA')."""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def build_column_letter_map(column_names) -> dict:
+    """Maps each actual column name to its traditional Excel column letter, in sheet order."""
+    return {col_name: excel_column_letter(i) for i, col_name in enumerate(column_names)}
+
+
+def column_letter_index(letters: str) -> int:
+    """Converts an Excel column letter to its zero-based column index ('A' -> 0, 'AA' -> 26)."""
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+# Matches column letter references such as "Column C", "columns c and E", "cols A, B, & F", "columns C+D" or ranges like
+# "columns A to D", "columns B-D" and "columns A through C"
+COLUMN_LETTER_RANGE = r'[A-Z]{1,3}(?:\s*(?:-|\u2013|\bto\b|\bthrough\b|\bthru\b)\s*[A-Z]{1,3})?'
+COLUMN_LETTER_SEPARATOR = r'\s*(?:,\s*(?:and|or)\b|,|&|/|\+|\band\b|\bor\b)\s*'
+COLUMN_LETTER_REFERENCE_PATTERN = re.compile(
+    rf'\b(?:columns?|cols?)\s+({COLUMN_LETTER_RANGE}(?:{COLUMN_LETTER_SEPARATOR}{COLUMN_LETTER_RANGE})*)\b', re.IGNORECASE
+)
+COLUMN_LETTER_SEPARATOR_PATTERN = re.compile(COLUMN_LETTER_SEPARATOR, re.IGNORECASE)
+# A letter-like token still attached to a matched reference list (e.g. "columns C; D" or "columns C*D") means the list was not fully understood
+COLUMN_LETTER_TRAILING_PATTERN = re.compile(r'\s*[-+,&/;:*|]\s*[A-Z]{1,3}\b', re.IGNORECASE)
+COLUMN_LETTER_RANGE_SEPARATOR_PATTERN = re.compile(r'\s*(?:-|\u2013|\bto\b|\bthrough\b|\bthru\b)\s*', re.IGNORECASE)
+# Lowercase words after "column" that are ordinary English rather than column letters (e.g. "the column to fill")
+COLUMN_LETTER_STOP_WORDS = {"to", "in", "of", "is", "by", "for", "the", "as", "at", "if", "on", "it", "be", "are", "was", "has", "an", "all", "any", "one", "two", "you", "and", "or"}
+
+
+def resolve_command_columns(column_letters: dict, command: str) -> list:
+    """
+    Works out which columns a command refers to, either by Excel column letter (single letters or ranges) or by actual column name.
+    Returns the matching column names in sheet order, or an empty list if nothing could be resolved or if a column letter
+    reference does not exist in the sheet (then the command may need columns we cannot identify, so all are sent).
+    """
+    columns = list(column_letters)
+    referenced = set()
+
+    for match in COLUMN_LETTER_REFERENCE_PATTERN.finditer(command):
+        if COLUMN_LETTER_TRAILING_PATTERN.match(command, match.end()):
+            print(f"DEBUG: Column reference '{match.group(0)}' is followed by more letter-like tokens, sending all columns to the AI.")
+            return []
+        for reference in COLUMN_LETTER_SEPARATOR_PATTERN.split(match.group(1)):
+            letters = COLUMN_LETTER_RANGE_SEPARATOR_PATTERN.split(reference)
+            if len(letters) == 1 and letters[0].lower() in COLUMN_LETTER_STOP_WORDS and letters[0].islower():
+                continue
+            indexes = [column_letter_index(letter) for letter in letters]
+            if max(indexes) >= len(columns):
+                print(f"DEBUG: Command references column(s) '{reference}' outside the sheet, sending all columns to the AI.")
+                return []
+            referenced.update(columns[min(indexes):max(indexes) + 1])
+
+    command_lower = command.lower()
+    for col_name in column_letters:
+        name = str(col_name).strip().lower()
+        # Placeholder headers like 'Unnamed: 2' can only be referenced by letter
+        if not name or name.startswith("unnamed:"):
+            continue
+        if re.search(r'(?<!\w)' + re.escape(name) + r'(?!\w)', command_lower):
+            referenced.add(col_name)
 
-        # Check if it's an explanatory or non-content line (these lines should be completely ignored)
-        # Avoid deleting actual list items (e.g., if an item itself is "results:")
-        is_potential_explanatory_line = any(keyword in stripped_line.lower() for keyword in filter_keywords)
-
-        # If it's an explanatory line and does not appear to be an actual list item, skip
-        if is_potential_explanatory_line and not stripped_line.startswith('*'):
-            continue # Only skip if it's an explanatory line and not a markdown list item
-
-        # Strictly match lines starting with a Markdown list symbol, extract content and clean it
-        # Must start with *, followed by a space, then the content
-        match = re.match(r'^\*\s*(.+)$', stripped_line)
-        if match:
-            item = match.group(1).strip()
-            # Remove potential bold formatting (**)
-            item = re.sub(r'^\**', '', item)
-            item = re.sub(r'\**$', '', item)
-            # Remove parenthesized data after company names (e.g., (4453))
-            item = re.sub(r'\s*\(\d+\)$', '', item).strip()
-            # Remove potential numbering (e.g., "1. Item", "2) Item")
-            item = re.sub(r'^\d+\.?\s*\)?\s*', '', item).strip()
-
-            if item:
-                parsed_items.append(item)
-
-    return parsed_items
+    return [col_name for col_name in column_letters if col_name in referenced]
 
 
-# Core change: process_ai_command now always instructs AI to output a Markdown list
-def process_ai_command(dataframe: pd.DataFrame, command: str) -> str:
+def project_dataframe_for_command(dataframe: pd.DataFrame, command: str, column_letters: dict | None = None) -> pd.DataFrame:
     """
-    Processes AI commands using the Google Gemini model.
-    AI will be instructed to always output a Markdown list for consistency.
+    Keeps only the columns a command refers to, so unrelated columns are never sent to the model.
+    Falls back to all columns when the command does not reference any column explicitly.
     """
-    if not API_KEY:
-        return "ERROR: Gemini API is not configured, cannot process AI command."
+    column_letters = column_letters or build_column_letter_map(dataframe.columns)
+    referenced_columns = resolve_command_columns(column_letters, command)
+    if not referenced_columns:
+        print("DEBUG: Command does not reference specific columns, sending all columns to the AI.")
+        return dataframe
+
+    print(f"DEBUG: Sending only referenced columns to the AI: {referenced_columns}")
+    return dataframe[referenced_columns]
+
+
+# --- Prompt Data Encoding ---
+# The CSV encoding repeats long values verbatim and spells out float noise. The compact encodings write one numbered
+# line per row with trimmed numbers, and the dictionary encoding additionally replaces repeated long values with
+# short ids explained in a legend. Every encoding keeps exactly one line per data row, so the per-row results still
+# line up with the sheet's rows.
+
+PROMPT_ENCODING_NOTES = {
+    "csv": "",
+    "numbered": (
+        "The first data line lists the column names. Each following line is one data row: its row number, then its cell values in column order, "
+        "all separated by '|'. Empty cells are left blank, and '\\|', '\\n' and '\\\\' inside a value stand for '|', a line break and '\\'. "
+        "Row numbers are only for reference; do not include them in your response.\n"
+    ),
+}
+PROMPT_ENCODING_NOTES["dictionary"] = PROMPT_ENCODING_NOTES["numbered"] + (
+    "Repeated values are abbreviated as @1, @2, ...; the Legend lines map each abbreviation to its full value. "
+    "Always use the full values in your response, never the abbreviations.\n"
+)
+PROMPT_ENCODING_DESCRIPTIONS = {"csv": "in CSV format", "numbered": "as numbered rows", "dictionary": "as numbered rows with a legend"}
+PROMPT_ENCODING_LABELS = {"csv": "CSV Format", "numbered": "Numbered Rows", "dictionary": "Numbered Rows with Legend"}
+PROMPT_DICTIONARY_ID_PATTERN = re.compile(r'^@\d+$')
+
+
+def format_prompt_value(value) -> str:
+    """Formats one cell for the compact encodings: blank for missing values, trimmed decimals, escaped separators."""
+    if isinstance(value, str):
+        text = value
+    elif value is None or pd.isna(value):
+        return ""
+    elif isinstance(value, (float, np.floating)):
+        number = float(value)
+        if number.is_integer() and abs(number) <= 2 ** 53: # Every integer up to 2**53 is exact in a float (e.g. IDs read as floats because of blanks)
+            return str(int(number))
+        return f"{number:.{PROMPT_FLOAT_SIGNIFICANT_DIGITS}g}"
+    else:
+        text = str(value)
+    if '|' in text or '\n' in text or '\r' in text or '\\' in text:
+        text = text.replace('\\', '\\\\').replace('|', '\\|').replace('\r\n', '\\n').replace('\n', '\\n').replace('\r', '\\n')
+    return text
 
-    old_stdout = sys.stdout
-    redirected_output = io.StringIO()
-    sys.stdout = redirected_output
 
-    try:
-        df_csv_string = dataframe.to_csv(index=False)
-        original_rows_count = dataframe.shape[0]
-
-        # Construct column mapping reference, precise and emphatic
-        column_names_list = dataframe.columns.tolist()
-        column_info_str = "Please strictly refer to the following actual column names (Column Names) in the Excel data:\n"
-        for i, col_name in enumerate(column_names_list):
-            column_info_str += f"- Actual Column Name: '{col_name}' (May correspond to traditional Excel Column {chr(65 + i)})\n"
-        column_info_str += "\n**EXTREMELY IMPORTANT:** When a user command mentions an Excel column letter (e.g., 'Column C', 'Column E'), you **MUST** accurately determine and use the actual column name from the CSV data provided (e.g., 'Unnamed: 2' for 'Column C').\n"
-        column_info_str += "For example, if the user mentions 'Column C', and its corresponding actual column name is 'Unnamed: 2', you **MUST USE** 'Unnamed: 2' to process the data.\n"
-        column_info_str += "Ensure you only process columns explicitly specified by the user, do not extend to other unmentioned columns.\n"
-        column_info_str += "If the command involves de-duplication, please strictly perform the de-duplication operation.\n" # Emphasize de-duplication
-
-
-        prompt = f"""You are a powerful data analysis assistant.
-You will receive a segment of data from an Excel file (in CSV format), and a command from the user regarding this data.
+def build_prompt_dictionary(formatted_columns: list) -> dict | None:
+    """
+    Assigns ids (@1, @2, ...) to repeated values whose abbreviation saves more characters than its legend line costs.
+    Returns {value: id}, or None if nothing is worth abbreviating or cells already look like ids.
+    """
+    counts = Counter()
+    for column in formatted_columns:
+        for cell in column:
+            if len(cell) >= PROMPT_DICTIONARY_MIN_LENGTH:
+                counts[cell] += 1
+            elif cell.startswith('@') and PROMPT_DICTIONARY_ID_PATTERN.match(cell):
+                return None # Abbreviations would be ambiguous
+
+    value_ids = {}
+    for value, count in counts.most_common():
+        if count < 2:
+            break
+        value_id = f"@{len(value_ids) + 1}"
+        legend_chars = len(value_id) + len(value) + 2
+        if count * (len(value) - len(value_id)) > legend_chars:
+            value_ids[value] = value_id
+    return value_ids or None
+
+
+def encode_numbered_rows(dataframe: pd.DataFrame, formatted_columns: list, value_ids: dict | None = None) -> str:
+    """Writes a header line and one "row number|value|value..." line per row, with a legend first when value_ids are given."""
+    lines = []
+    if value_ids:
+        lines.append("Legend:")
+        lines += [f"{value_id}={value}" for value, value_id in value_ids.items()]
+        lines.append("Rows:")
+        formatted_columns = [[value_ids.get(cell, cell) for cell in column] for column in formatted_columns]
+    lines.append("#|" + "|".join(format_prompt_value(str(col_name)) for col_name in dataframe.columns))
+    lines += [f"{row_number}|" + "|".join(cells) for row_number, cells in enumerate(zip(*formatted_columns), start=1)]
+    return "\n".join(lines) + "\n"
+
+
+def encode_prompt_data(dataframe: pd.DataFrame) -> tuple:
+    """
+    Encodes a DataFrame for a prompt with the configured encoding, or with the cheapest one by estimate_tokens when
+    PROMPT_ENCODING is "auto". Returns (encoding_name, data_text).
+    """
+    forced_encoding = PROMPT_ENCODING if PROMPT_ENCODING in PROMPT_ENCODING_NOTES else None
+    if forced_encoding == "csv" or dataframe.shape[1] == 0:
+        return "csv", dataframe.to_csv(index=False)
+
+    candidates = {}
+    if forced_encoding is None:
+        candidates["csv"] = dataframe.to_csv(index=False)
+    formatted_columns = [[format_prompt_value(value) for value in dataframe.iloc[:, position].tolist()] for position in range(dataframe.shape[1])]
+    if forced_encoding != "dictionary":
+        candidates["numbered"] = encode_numbered_rows(dataframe, formatted_columns)
+    if forced_encoding != "numbered":
+        value_ids = build_prompt_dictionary(formatted_columns)
+        if value_ids:
+            candidates["dictionary"] = encode_numbered_rows(dataframe, formatted_columns, value_ids)
+    if not candidates: # Forced dictionary encoding, but no value is worth abbreviating
+        candidates["numbered"] = encode_numbered_rows(dataframe, formatted_columns)
+
+    encoding = min(candidates, key=lambda name: estimate_tokens(PROMPT_ENCODING_NOTES[name] + candidates[name]))
+    if len(candidates) > 1:
+        estimates = ", ".join(f"{name} ~{estimate_tokens(PROMPT_ENCODING_NOTES[name] + text)}" for name, text in candidates.items())
+        print(f"DEBUG: Prompt data encoding '{encoding}' chosen (estimated tokens: {estimates}).")
+    return encoding, candidates[encoding]
+
+
+def build_ai_prompt(dataframe: pd.DataFrame, command: str, column_letters: dict | None = None) -> str:
+    """
+    Builds the Gemini prompt for a DataFrame and a user command.
+    column_letters maps each column to its letter in the original sheet, which matters when the DataFrame is a column projection.
+    The prompt always instructs the AI to answer with a Markdown list.
+    """
+    data_encoding, data_text = encode_prompt_data(dataframe)
+    original_rows_count = dataframe.shape[0]
+
+    # Construct column mapping reference, precise and emphatic
+    column_letters = column_letters or build_column_letter_map(dataframe.columns)
+    column_info_str = "Please strictly refer to the following actual column names (Column Names) in the Excel data:\n"
+    for col_name in dataframe.columns:
+        column_info_str += f"- Actual Column Name: '{col_name}' (May correspond to traditional Excel Column {column_letters[col_name]})\n"
+    column_info_str += "\n**EXTREMELY IMPORTANT:** When a user command mentions an Excel column letter (e.g., 'Column C', 'Column E'), you **MUST** accurately determine and use the actual column name from the data provided (e.g., 'Unnamed: 2' for 'Column C').\n"
+    column_info_str += "For example, if the user mentions 'Column C', and its corresponding actual column name is 'Unnamed: 2', you **MUST USE** 'Unnamed: 2' to process the data.\n"
+    column_info_str += "Ensure you only process columns explicitly specified by the user, do not extend to other unmentioned columns.\n"
+    column_info_str += "If the command involves de-duplication, please strictly perform the de-duplication operation.\n" # Emphasize de-duplication
+
+
+    return f"""You are a powerful data analysis assistant.
+You will receive a segment of data from an Excel file ({PROMPT_ENCODING_DESCRIPTIONS[data_encoding]}), and a command from the user regarding this data.
 Please analyze the provided data based on the user's command and give a clear, concise response.
-
+{PROMPT_ENCODING_NOTES[data_encoding]}
 {column_info_str}
 
 ---
-Excel Data (CSV Format):
-{df_csv_string}
+Excel Data ({PROMPT_ENCODING_LABELS[data_encoding]}):
+{data_text}
 ---
 
 User Command: {command}
@@ -162,21 +866,937 @@ User Command: {command}
 Your Response (ONLY a Markdown list, with no other text, formatting, or explanations):
 """
 
-        print(f"\n--- Full Prompt Sent to Gemini ---\n{prompt}\n--- End of Prompt ---") # Log: Print full prompt
 
-        model = genai.GenerativeModel('gemini-2.0-flash')
+def extract_response_text(response) -> str | None:
+    """Returns the text of the first Gemini candidate, or None if the response is empty."""
+    if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts and response.candidates[0].content.parts[0].text:
+        return response.candidates[0].content.parts[0].text
+    return None
+
+
+def store_ai_text(prompt: str, response_text: str):
+    """Stores a response in the response cache (if enabled)."""
+    if RESPONSE_CACHE_ENABLED and response_text:
+        response_cache.put(response_cache.make_key(GEMINI_MODEL_NAME, prompt), response_text)
+
+
+def generate_ai_text(prompt: str, use_cache: bool = True, store_in_cache: bool = True) -> str | None:
+    """
+    Sends a prompt to Gemini, answering repeated prompts from the response cache.
+    use_cache=False always asks the model (e.g. to retry a bad answer); store_in_cache=False leaves caching to the caller,
+    which can then store only responses it has validated (see store_ai_text).
+    Returns None if the model did not produce a usable response (such responses are not cached).
+    """
+    cache_key = response_cache.make_key(GEMINI_MODEL_NAME, prompt) if RESPONSE_CACHE_ENABLED else None
+    if cache_key and use_cache:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            print(f"DEBUG: Response cache hit for key {cache_key[:12]}.")
+            return cached_text
+
+    with stage_span("gemini_call"):
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
         response = model.generate_content(prompt)
+    response_text = extract_response_text(response)
+    record_token_usage(response, prompt, response_text)
+    if cache_key and store_in_cache and response_text:
+        response_cache.put(cache_key, response_text)
+    return response_text
+
+
+def stream_ai_text(prompt: str):
+    """
+    Yields the Gemini response text piece by piece as it is generated (generate_content with stream=True).
+    Cached responses are yielded in one piece, and a completed stream is stored in the response cache.
+    """
+    cache_key = response_cache.make_key(GEMINI_MODEL_NAME, prompt) if RESPONSE_CACHE_ENABLED else None
+    if cache_key:
+        cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            print(f"DEBUG: Response cache hit for key {cache_key[:12]}.")
+            yield cached_text
+            return
+
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    received_pieces = []
+    response_chunk = None
+    for response_chunk in model.generate_content(prompt, stream=True):
+        piece = extract_response_text(response_chunk)
+        if piece:
+            received_pieces.append(piece)
+            yield piece
+
+    # The final chunk of a stream carries the usage metadata for the whole response
+    record_token_usage(response_chunk, prompt, "".join(received_pieces))
+    if cache_key and received_pieces:
+        response_cache.put(cache_key, "".join(received_pieces))
+
 
-        if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts and response.candidates[0].content.parts[0].text:
-            return response.candidates[0].content.parts[0].text
+# Core change: process_ai_command now always instructs AI to output a Markdown list
+def process_ai_command(dataframe: pd.DataFrame, command: str, column_letters: dict | None = None) -> str:
+    """
+    Processes AI commands using the Google Gemini model.
+    AI will be instructed to always output a Markdown list for consistency.
+    """
+    if not API_KEY:
+        return "ERROR: Gemini API is not configured, cannot process AI command."
+
+    try:
+        with stage_span("build_prompt"):
+            prompt = build_ai_prompt(dataframe, command, column_letters)
+
+        print(f"DEBUG: Prompt sent to Gemini: {dataframe.shape[0]} rows, {dataframe.shape[1]} columns, {len(prompt)} characters (~{estimate_tokens(prompt)} tokens).")
+
+        response_text = generate_ai_text(prompt)
+        if response_text:
+            return response_text
         else:
             return "Gemini model could not generate a valid response. Please try another command."
 
     except Exception as e:
         print(f"Error calling Gemini API: {e}")
         return f"An error occurred while processing AI command: {str(e)}"
-    finally:
-        sys.stdout = old_stdout # Ensure logs are visible even on error
+
+
+def stream_ai_command(dataframe: pd.DataFrame, command: str, column_letters: dict | None = None, item_callback=None) -> tuple:
+    """
+    process_ai_command with the response streamed from Gemini and parsed as it arrives; item_callback is called with each
+    parsed list item as soon as it is complete. Returns (ai_response_text, parsed_results).
+    """
+    if not API_KEY:
+        ai_response_text = "ERROR: Gemini API is not configured, cannot process AI command."
+        return ai_response_text, parse_ai_response_to_list(ai_response_text)
+
+    response_pieces = []
+    def collect_pieces(pieces):
+        for piece in pieces:
+            response_pieces.append(piece)
+            yield piece
+
+    parsed_results = []
+    try:
+        with stage_span("build_prompt"):
+            prompt = build_ai_prompt(dataframe, command, column_letters)
+        print(f"DEBUG: Prompt streamed from Gemini: {dataframe.shape[0]} rows, {dataframe.shape[1]} columns, {len(prompt)} characters (~{estimate_tokens(prompt)} tokens).")
+
+        # Generation and parsing are interleaved here, so they are timed as one streaming stage
+        with stage_span("gemini_stream"):
+            for item in iter_parse_ai_response(collect_pieces(stream_ai_text(prompt))):
+                parsed_results.append(item)
+                item_callback(item)
+    except Exception as e:
+        print(f"Error calling Gemini API: {e}")
+        ai_response_text = f"An error occurred while processing AI command: {str(e)}"
+        return ai_response_text, parse_ai_response_to_list(ai_response_text)
+
+    ai_response_text = "".join(response_pieces) or "Gemini model could not generate a valid response. Please try another command."
+    return ai_response_text, parsed_results
+
+
+def dedupe_rows_for_prompt(dataframe: pd.DataFrame, unique_ids: dict | None = None, row_to_unique: list | None = None) -> tuple:
+    """
+    Collapses repeated input rows to their distinct value tuples, in order of first appearance.
+    Returns (unique_rows, row_to_unique), where row_to_unique[i] is the position of row i's values among all unique rows.
+    To dedupe a stream of batches, pass the same unique_ids dict and row_to_unique list to every call;
+    each call then returns only the rows not seen in earlier batches.
+    """
+    unique_ids = {} if unique_ids is None else unique_ids
+    row_to_unique = [] if row_to_unique is None else row_to_unique
+    first_row_positions = []
+    for position, row_values in enumerate(dataframe.itertuples(index=False, name=None)):
+        unique_id = unique_ids.get(row_values)
+        if unique_id is None:
+            unique_id = unique_ids[row_values] = len(unique_ids)
+            first_row_positions.append(position)
+        row_to_unique.append(unique_id)
+    return dataframe.iloc[first_row_positions], row_to_unique
+
+
+def align_results_to_rows(results_callback, row_to_unique: list | None):
+    """
+    Adapts results_callback(index, values), which takes results per original row, to a callback that is given the results
+    for distinct inputs in order (as prompted after dedupe_rows_for_prompt). Each call reports the next run of original rows
+    whose results are now known, so index is always a row index. row_to_unique may still be growing (streamed batches);
+    None means the rows were not deduplicated.
+    """
+    distinct_results = []
+    next_row = 0
+
+    def on_distinct_results(values: list):
+        nonlocal next_row
+        distinct_results.extend(values)
+        first_row = next_row
+        if row_to_unique is None:
+            next_row = len(distinct_results)
+            results_callback(first_row, list(values))
+            return
+        while next_row < len(row_to_unique) and row_to_unique[next_row] < len(distinct_results):
+            next_row += 1
+        if next_row > first_row:
+            results_callback(first_row, [distinct_results[row_to_unique[row]] for row in range(first_row, next_row)])
+
+    return on_distinct_results
+
+
+def fan_out_results(unique_results: list, row_to_unique: list) -> list:
+    """Maps per-unique-row AI results back to every original row (missing results become blanks)."""
+    return [unique_results[i] if i < len(unique_results) else None for i in row_to_unique]
+
+
+def expand_deduplicated_results(parsed_results: list, row_to_unique: list, unique_rows_count: int, ai_response_text: str) -> tuple:
+    """Fans results for distinct inputs back out to every row, noting a count mismatch in the response. Returns (parsed_results, ai_response_text)."""
+    if len(parsed_results) != unique_rows_count:
+        warning_msg = f"WARNING: AI output count ({len(parsed_results)}) does not match distinct input rows ({unique_rows_count}). Results will be adjusted to fit the new column (may be truncated or padded with blanks)."
+        print(warning_msg)
+        ai_response_text += f"\n\nNote: {warning_msg}"
+    return fan_out_results(parsed_results, row_to_unique), ai_response_text
+
+
+def split_dataframe_into_chunks(dataframe: pd.DataFrame, token_budget: int | None = None) -> list:
+    """
+    Splits a DataFrame into consecutive row chunks whose CSV payload roughly fits the token budget.
+    Returns a single chunk when the whole sheet fits into one prompt.
+    """
+    token_budget = token_budget or CHUNK_TOKEN_BUDGET
+    total_rows = dataframe.shape[0]
+    if total_rows == 0:
+        return [dataframe]
+
+    # Estimate each row's CSV size without serializing the whole sheet (cell text + separators)
+    row_chars = dataframe.astype(str).apply(lambda column: column.str.len()).sum(axis=1) + dataframe.shape[1]
+    row_tokens = (row_chars.to_numpy() // 4) + 1
+    chunk_ids = (np.cumsum(row_tokens) - 1) // token_budget
+
+    boundaries = (np.flatnonzero(np.diff(chunk_ids)) + 1).tolist()
+    starts = [0] + boundaries
+    ends = boundaries + [total_rows]
+    return [dataframe.iloc[start:end] for start, end in zip(starts, ends)]
+
+
+def process_ai_chunk(chunk_index: int, chunk: pd.DataFrame, command: str, column_letters: dict | None = None) -> tuple:
+    """
+    Sends one row chunk to Gemini, retrying on errors or row-count mismatches.
+    Returns (raw_response_text, per_row_results, chunk_stats), where per_row_results always has one entry per chunk row.
+    """
+    with stage_span("build_prompt"):
+        prompt = build_ai_prompt(chunk, command, column_letters)
+    chunk_rows = chunk.shape[0]
+    started = time.perf_counter()
+
+    response_text = ""
+    parsed_items = []
+    status = "failed"
+    attempts = 0
+
+    for attempt in range(1, CHUNK_MAX_RETRIES + 2):
+        attempts = attempt
+        try:
+            # Only the first attempt may be answered from the cache (a retry must not get the same bad answer back),
+            # and only responses with one item per row are cached
+            candidate_text = generate_ai_text(prompt, use_cache=attempt == 1, store_in_cache=False)
+            if not candidate_text:
+                raise ValueError("Gemini model returned an empty response.")
+
+            response_text = candidate_text
+            with stage_span("parse_response"):
+                parsed_items = parse_ai_response_to_list(candidate_text)
+            if len(parsed_items) == chunk_rows:
+                status = "ok"
+                store_ai_text(prompt, candidate_text)
+                break
+            status = "row_mismatch"
+            print(f"WARNING: Chunk {chunk_index} attempt {attempt} returned {len(parsed_items)} items for {chunk_rows} rows.")
+        except Exception as e:
+            response_text = f"ERROR: Chunk {chunk_index} failed: {e}"
+            print(f"WARNING: Chunk {chunk_index} attempt {attempt} failed: {e}")
+
+        if attempt <= CHUNK_MAX_RETRIES:
+            time.sleep(CHUNK_RETRY_BACKOFF_SECONDS * attempt)
+
+    # Align this chunk's results to its own rows, so one bad chunk cannot shift the rows of the others
+    aligned_items = parsed_items[:chunk_rows] + [None] * max(chunk_rows - len(parsed_items), 0)
+
+    chunk_stats = {
+        "chunk": chunk_index,
+        "rows": chunk_rows,
+        "parsed_items": len(parsed_items),
+        "attempts": attempts,
+        "status": status,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    return response_text, aligned_items, chunk_stats
+
+
+def process_ai_command_chunked(chunks, command: str, column_letters: dict | None = None, chunk_callback=None) -> tuple:
+    """
+    Processes row chunks concurrently through a bounded worker pool.
+    chunks may be a lazy iterable (e.g. batches streamed from the workbook); only a bounded window of chunks is held at once.
+    chunk_callback, if given, is called with each chunk's per-row results as soon as they are available, in row order.
+    Returns (ai_response_text, parsed_results, chunk_stats) with results stitched back in original row order.
+    """
+    if not API_KEY:
+        return "ERROR: Gemini API is not configured, cannot process AI command.", [], []
+
+    outcomes = []
+    def collect(outcome):
+        outcomes.append(outcome)
+        if chunk_callback:
+            chunk_callback(outcome[1])
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max(1, CHUNK_MAX_WORKERS)) as executor:
+        for chunk_index, chunk in enumerate(chunks):
+            # Each chunk runs in a copy of the caller's context, so its stages are recorded in the caller's pipeline metrics
+            in_flight.append(executor.submit(contextvars.copy_context().run, process_ai_chunk, chunk_index, chunk, command, column_letters))
+            # Futures are collected in submission order, which keeps rows in their original order
+            if len(in_flight) >= 2 * max(1, CHUNK_MAX_WORKERS):
+                collect(in_flight.popleft().result())
+        while in_flight:
+            collect(in_flight.popleft().result())
+
+    response_texts = [outcome[0] for outcome in outcomes]
+    parsed_results = [item for outcome in outcomes for item in outcome[1]]
+    chunk_stats = [outcome[2] for outcome in outcomes]
+
+    for stats in chunk_stats:
+        print(f"DEBUG: Chunk {stats['chunk']}: {stats['rows']} rows, {stats['parsed_items']} items, {stats['attempts']} attempt(s), status '{stats['status']}', {stats['seconds']}s")
+
+    return "\n".join(response_texts), parsed_results, chunk_stats
+
+
+def read_excel_sheet(filepath: str, sheet_name: str) -> tuple:
+    """Reads the requested sheet (or the first sheet) of an Excel file. Returns (DataFrame, actual_sheet_name)."""
+    xls = pd.ExcelFile(filepath)
+    if sheet_name and sheet_name in xls.sheet_names:
+        actual_sheet_name_read = sheet_name
+        df = pd.read_excel(xls, sheet_name=actual_sheet_name_read, header=0)
+        print(f"Successfully read sheet '{actual_sheet_name_read}'. First 5 rows of data:")
+    else:
+        actual_sheet_name_read = xls.sheet_names[0]
+        df = pd.read_excel(xls, sheet_name=actual_sheet_name_read, header=0)
+        print(f"No sheet name specified. Defaulting to read the first sheet '{actual_sheet_name_read}'. First 5 rows of data:")
+    return df, actual_sheet_name_read
+
+
+def make_unique_column_names(header_values) -> list:
+    """
+    Names header cells exactly the way pandas does. Blank headers become 'Unnamed: i'. Duplicates get '.1', '.2'
+    suffixes, skipping any suffixed name that appears in the header itself, e.g. ['a', 'a', 'a.1'] -> ['a', 'a.2', 'a.1'].
+    Named headers are deduplicated before the 'Unnamed: i' placeholders.
+    """
+    is_blank = [value is None or (isinstance(value, str) and not value.strip()) for value in header_values]
+    column_names = [f"Unnamed: {i}" if blank else value for i, (value, blank) in enumerate(zip(header_values, is_blank))]
+    header_names = {name for name, blank in zip(column_names, is_blank) if not blank}
+    used_names = set()
+    suffix_counts = {}
+    for i in sorted(range(len(column_names)), key=lambda i: is_blank[i]):
+        name = base_name = column_names[i]
+        if name in used_names:
+            count = suffix_counts.get(base_name, 0)
+            while name in used_names or name in header_names:
+                count += 1
+                name = f"{base_name}.{count}"
+            suffix_counts[base_name] = count
+        used_names.add(name)
+        column_names[i] = name
+    return column_names
+
+
+def open_sheet_for_streaming(filepath: str, sheet_name: str) -> tuple:
+    """Opens the requested sheet (or the first sheet) of an .xlsx file in read-only mode. Returns (workbook, worksheet, actual_sheet_name)."""
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    actual_sheet_name_read = sheet_name if sheet_name and sheet_name in workbook.sheetnames else workbook.sheetnames[0]
+    return workbook, workbook[actual_sheet_name_read], actual_sheet_name_read
+
+
+def count_sheet_data_rows(worksheet, limit: int | None = None) -> int:
+    """
+    Returns the number of data rows (below the header) of a read-only worksheet.
+    Uses the sheet's dimension record when it has one; otherwise (e.g. for openpyxl write-only output) the rows are
+    counted by streaming through them, stopping once limit rows are exceeded.
+    """
+    if worksheet.max_row is not None and worksheet.max_row > 1:
+        return worksheet.max_row - 1
+    rows = worksheet.iter_rows(values_only=True)
+    if limit is not None:
+        rows = itertools.islice(rows, limit + 2)
+    return max(sum(1 for _ in rows) - 1, 0)
+
+
+def iter_sheet_row_batches(worksheet, batch_rows: int):
+    """
+    Streams a read-only worksheet as DataFrame batches of at most batch_rows rows, using the first row as the header.
+    Column names and trailing empty rows are handled like pd.read_excel, so row positions match the regular read path.
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = make_unique_column_names(header)
+    width = len(columns)
+    empty_row = (None,) * width
+
+    batch = []
+    pending_empty_rows = 0 # Empty rows are only kept if a non-empty row follows them
+    for row in rows:
+        row = tuple(row[:width]) + (None,) * (width - len(row))
+        if row == empty_row:
+            pending_empty_rows += 1
+            continue
+        batch.extend([empty_row] * pending_empty_rows)
+        pending_empty_rows = 0
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield pd.DataFrame(batch, columns=columns, dtype=object) # object dtype keeps empty cells as None
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch, columns=columns, dtype=object)
+
+
+def append_column_to_sheet(filepath: str, sheet_name: str, column_name: str, values: list):
+    """
+    Writes a result column into an existing worksheet in a single pass: the workbook is opened once,
+    only the column's cells are written (header in the first row, one value per data row below it), and it is saved once.
+    If the sheet already has a column with this header, that column is overwritten instead.
+    """
+    book = load_workbook(filepath)
+    sheet = book[sheet_name]
+
+    header_cells = next(sheet.iter_rows(min_row=1, max_row=1), ())
+    existing_column = next((cell.column for cell in header_cells if cell.value == column_name), None)
+
+    if existing_column:
+        column_index = existing_column
+        # Clear stale values below the new results
+        for (cell,) in sheet.iter_rows(min_row=len(values) + 2, min_col=column_index, max_col=column_index):
+            cell.value = None
+    else:
+        column_index = sheet.max_column + 1
+        header_cell = sheet.cell(row=1, column=column_index, value=column_name)
+        # Match the look of the neighbouring header cell
+        neighbour_header = sheet.cell(row=1, column=column_index - 1) if column_index > 1 else None
+        if neighbour_header is not None and neighbour_header.has_style:
+            header_cell._style = copy.copy(neighbour_header._style)
+
+    for row_index, value in enumerate(values, start=2):
+        if isinstance(value, float) and np.isnan(value):
+            value = None # Missing results are written as blank cells
+        if value is not None or existing_column:
+            sheet.cell(row=row_index, column=column_index).value = value
+
+    with atomic_write_path(filepath) as temp_path:
+        book.save(temp_path)
+
+
+def is_streamed_sheet(worksheet) -> bool:
+    """True if a read-only worksheet has more data rows than STREAMING_ROW_THRESHOLD (new-column jobs then stream it)."""
+    return count_sheet_data_rows(worksheet, limit=STREAMING_ROW_THRESHOLD) > STREAMING_ROW_THRESHOLD
+
+
+def streaming_progress(rows_read: int, expected_rows: int | None) -> float:
+    """Progress fraction of the processing stage of a streamed sheet (it stays at the stage start if the row count is unknown)."""
+    return 0.2 + 0.6 * min(rows_read / expected_rows, 1.0) if expected_rows else 0.2
+
+
+def stream_rows_to_ai(workbook, first_batch: pd.DataFrame, batches, command: str, column_letters: dict, referenced_columns: list,
+                      expected_rows: int | None, report_progress, results_callback=None) -> tuple:
+    """
+    Sends streamed row batches to the AI: each batch is projected, deduplicated against earlier batches and split into chunks.
+    Closes the read-only workbook once all rows are read. Returns (ai_response_text, parsed_results, chunk_stats).
+    results_callback, if given, is called as results_callback(row_index, values) as the results of the rows become known.
+    """
+    unique_ids = {}
+    row_to_unique = []
+    chunk_callback = align_results_to_rows(results_callback, row_to_unique) if results_callback else None
+
+    def prompt_chunks():
+        for batch in itertools.chain([first_batch], batches):
+            new_unique_rows, _ = dedupe_rows_for_prompt(batch[referenced_columns], unique_ids, row_to_unique)
+            report_progress(streaming_progress(len(row_to_unique), expected_rows), "processing")
+            if not new_unique_rows.empty:
+                yield from split_dataframe_into_chunks(new_unique_rows)
+
+    ai_response_text, unique_results, chunk_stats = process_ai_command_chunked(prompt_chunks(), command, column_letters, chunk_callback)
+    workbook.close() # Release the read-only handle before the workbook is rewritten
+    print(f"DEBUG: Streamed {len(row_to_unique)} rows, {len(unique_ids)} distinct inputs, {len(chunk_stats)} chunks.")
+    return ai_response_text, fan_out_results(unique_results, row_to_unique), chunk_stats
+
+
+def run_streaming_new_column_pipeline(workbook, worksheet, filepath_original: str, original_filename: str, actual_sheet_name_read: str,
+                                      command: str, new_column_name: str, host_url: str, report_progress,
+                                      preview_callback=None, results_callback=None) -> dict:
+    """
+    New-column pipeline for large .xlsx sheets: rows are streamed from a read-only worksheet in batches
+    and either transformed locally or sent to the AI in chunks, so the whole sheet is never loaded into a DataFrame.
+    preview_callback and results_callback are called as in execute_excel_pipeline.
+    """
+    # Without a dimension record the row count is unknown (counting would mean an extra pass over the sheet)
+    expected_rows = worksheet.max_row - 1 if worksheet.max_row and worksheet.max_row > 1 else None
+    print(f"DEBUG: Streaming {expected_rows or 'an unknown number of'} rows of sheet '{actual_sheet_name_read}' in batches of {STREAMING_BATCH_ROWS}.")
+
+    batches = iter_sheet_row_batches(worksheet, STREAMING_BATCH_ROWS)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        raise ValueError(f"Sheet '{actual_sheet_name_read}' is empty.")
+
+    print(f"\n--- Actual Column Names Read from Workbook ---\n{first_batch.columns.tolist()}\n--- End of Actual Column Names ---")
+    print(first_batch.head())
+    if preview_callback:
+        preview_callback(first_batch.head().to_dict(orient='records'))
+
+    # Only the columns referenced by the command are sent to the AI, keeping their original column letters
+    column_letters = build_column_letter_map(first_batch.columns)
+    referenced_columns = resolve_command_columns(column_letters, command) or first_batch.columns.tolist()
+    print(f"DEBUG: Sending columns {referenced_columns} to the AI.")
+
+    # Row-wise local commands (e.g. "uppercase column B") are applied batch by batch without calling the AI
+    local_plan = plan_local_command(command, column_letters)
+    if local_plan and local_plan["rowwise"]:
+        parsed_results = []
+        for batch in itertools.chain([first_batch], batches):
+            with stage_span("local_command"):
+                batch_results = run_local_plan(local_plan, batch)[1]
+            if results_callback:
+                results_callback(len(parsed_results), batch_results)
+            parsed_results.extend(batch_results)
+            report_progress(streaming_progress(len(parsed_results), expected_rows), "processing")
+        workbook.close()
+        ai_response_text = "\n".join(f"* {item}" if item is not None else "*" for item in parsed_results)
+        chunk_stats = []
+    else:
+        ai_response_text, parsed_results, chunk_stats = stream_rows_to_ai(workbook, first_batch, batches, command, column_letters,
+                                                                          referenced_columns, expected_rows, report_progress, results_callback)
+
+    report_progress(0.8, "writing")
+    download_url = None
+    try:
+        with stage_span("write_results"):
+            append_column_to_sheet(filepath_original, actual_sheet_name_read, new_column_name, parsed_results)
+        print(f"AI processed results added as new column '{new_column_name}' to sheet '{actual_sheet_name_read}' in original file '{original_filename}', preserving other sheets.")
+        download_url = build_download_url(host_url, filepath_original)
+    except Exception as writer_e:
+        print(f"ERROR: Problem writing new column results to original Excel file: {writer_e}")
+        ai_response_text += f"\n\nERROR: Could not write results as a new column to the original Excel file. Please ensure the file is not in use and re-upload. Detailed error: {writer_e}"
+
+    preview_df = first_batch.head().copy()
+    preview_df[new_column_name] = parsed_results[:preview_df.shape[0]]
+    return {
+        "message": "File upload, reading, and AI processing successful!",
+        "filename": original_filename,
+        "data_preview": preview_df.to_dict(orient='records'),
+        "ai_response": ai_response_text,
+        "download_url": download_url,
+        "chunk_stats": chunk_stats,
+    }
+
+
+def write_pipeline_results(df: pd.DataFrame, parsed_results: list, ai_response_text: str, filepath_original: str, original_filename: str,
+                           actual_sheet_name_read: str, output_mode: str, new_column_name: str, host_url: str) -> tuple:
+    """
+    Writes parsed AI results according to the output mode (in new-column mode, the column is also added to df for the preview).
+    Returns (ai_response_text, download_url); write problems are reported by appending a note to ai_response_text.
+    """
+    original_df_rows = df.shape[0]
+    download_url = None
+
+    if output_mode == "new_column_original_sheet":
+        # Ensure AI output list length is compatible with DataFrame index
+        # If AI is expected to generate a value for each row, but the number of results don't match, issue a warning
+        if len(parsed_results) != original_df_rows:
+            warning_msg = f"WARNING: AI output count ({len(parsed_results)}) does not match original data rows ({original_df_rows}). Results will be adjusted to fit the new column (may be truncated or padded with blanks)."
+            print(warning_msg)
+            ai_response_text += f"\n\nNote: {warning_msg}"
+
+        # Critical final fix: Create an empty Series with the same length as the original DataFrame, then populate with AI results
+        new_column_series = pd.Series(index=df.index, dtype=object) # Create an empty Series with the correct index
+        # Populate the beginning of the new Series with parsed_results
+        # If parsed_results is shorter, the rest will be NaN (blank in Excel)
+        # If parsed_results is longer, it will be truncated
+        new_column_series.iloc[:min(len(parsed_results), original_df_rows)] = parsed_results[:min(len(parsed_results), original_df_rows)]
+        df[new_column_name] = new_column_series # Assign to the new column in DataFrame
+
+        print(f"DEBUG: New column '{new_column_name}' added to DataFrame.")
+        print(f"DEBUG: DataFrame tail (with new column): \n{df.tail()}") # Log DataFrame state
+
+        try:
+            # Only the new column's cells are written; existing cells, formatting and formulas are left untouched
+            append_column_to_sheet(filepath_original, actual_sheet_name_read, new_column_name, df[new_column_name].tolist())
+            print(f"AI processed results added as new column '{new_column_name}' to sheet '{actual_sheet_name_read}' in original file '{original_filename}', preserving other sheets.")
+
+            download_url = build_download_url(host_url, filepath_original)
+            print(f"DEBUG: Generated download URL (pointing to modified original file - new column mode): {download_url}")
+
+        except Exception as writer_e:
+            print(f"ERROR: Problem writing new column results to original Excel file: {writer_e}")
+            ai_response_text += f"\n\nERROR: Could not write results as a new column to the original Excel file. Please ensure the file is not in use and re-upload. Detailed error: {writer_e}"
+            download_url = None
+            print(f"DEBUG: Failed to write to original Excel file, no download link generated (new column mode). Error: {writer_e}")
+
+    elif output_mode == "new_sheet_original_file":
+        if parsed_results:
+            output_df = pd.DataFrame(parsed_results, columns=['AI_Processed_Result']) # Column name for the new sheet
+            try:
+                # The sheet is appended to a copy that then replaces the original, so downloads never see a half-written file
+                with atomic_write_path(filepath_original) as modified_excel_path:
+                    shutil.copyfile(filepath_original, modified_excel_path)
+                    with pd.ExcelWriter(modified_excel_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
+                        output_df.to_excel(writer, sheet_name="AI_Results", index=False) # Fixed sheet name
+                print(f"AI processed results written to 'AI_Results' sheet in original file '{original_filename}'.")
+
+                download_url = build_download_url(host_url, filepath_original)
+                print(f"DEBUG: Generated download URL (pointing to modified original file - new sheet mode): {download_url}")
+            except Exception as writer_e:
+                print(f"ERROR: Problem writing results to original Excel file (new sheet mode): {writer_e}")
+                ai_response_text += f"\n\nERROR: Could not write results to original Excel file. Please ensure the file is not in use and re-upload. Detailed error: {writer_e}"
+                download_url = None
+                print(f"DEBUG: Failed to write to original Excel file, no download link generated (new sheet mode). Error: {writer_e}")
+        else:
+            print("DEBUG: AI response could not be parsed into a list, no downloadable Excel file generated (new sheet mode).")
+            ai_response_text += "\n\nNote: AI response could not be parsed into a list, unable to generate result Excel file."
+            download_url = None
+
+    elif output_mode == "new_excel_file":
+        if parsed_results:
+            output_df = pd.DataFrame(parsed_results, columns=['AI_Processed_Result']) # Column name for the new file
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_filename_new = f"ai_result_{timestamp}.xlsx"
+            # Results go to the DOWNLOAD_FOLDER directory of the request that uploaded the original file
+            request_id = os.path.basename(os.path.dirname(filepath_original))
+            output_filepath_new = os.path.join(create_request_dir(app.config['DOWNLOAD_FOLDER'], request_id), output_filename_new)
+
+            with atomic_write_path(output_filepath_new) as temp_path:
+                output_df.to_excel(temp_path, index=False)
+            print(f"AI processed results saved as new Excel file: {output_filepath_new}")
+
+            download_url = build_download_url(host_url, output_filepath_new)
+            print(f"DEBUG: Generated download URL (pointing to new file): {download_url}")
+        else:
+            print("DEBUG: AI response could not be parsed into a list, no downloadable Excel file generated (new file mode).")
+            ai_response_text += "\n\nNote: AI response could not be parsed into a list, unable to generate result Excel file."
+            download_url = None
+
+    else: # If output_mode is unknown
+        print(f"ERROR: Unknown output mode: {output_mode}")
+        ai_response_text += "\n\nERROR: Unknown output mode, unable to process download request."
+        download_url = None
+
+    return ai_response_text, download_url
+
+
+# --- Local Command Router ---
+# Simple, exactly answerable commands ("unique values in column C", "sum column E", "uppercase column B", ...)
+# are executed as vectorized pandas operations instead of being sent to Gemini.
+
+LOCAL_UNIQUE_PATTERN = re.compile(
+    r'^(?:extract|list|get|show|find|return)?\s*(?:all\s+)?(?:the\s+)?(?:unique|distinct|de-?duplicated)\s+(?:values?\s+|entries\s+|items\s+)?(?:in|of|from)\s+(?P<column>.+)$',
+    re.IGNORECASE
+)
+LOCAL_COUNT_PATTERN = re.compile(
+    r'^count\s+(?:the\s+)?(?:number\s+of\s+)?(?:all\s+)?rows'
+    r'(?:\s+where\s+(?P<column>.+?)\s+(?P<operator>is\s+not|not\s+equals?|equals?|is|contains|!=|==|>=|<=|=|>|<)\s+(?P<value>.+))?$',
+    re.IGNORECASE
+)
+# A count value that chains another condition ("... is X and Y > 3") is sent to the AI unless the value is quoted
+LOCAL_COUNT_COMPOUND_VALUE_PATTERN = re.compile(r'\b(?:and|or|is|equals?|contains)\b|[=<>!]', re.IGNORECASE)
+LOCAL_COUNT_QUOTED_VALUE_PATTERN = re.compile(r'([\'"`])([^\'"`]*)\1')
+LOCAL_COUNT_EMPTY_VALUES = {"empty", "blank"}
+LOCAL_COUNT_NEGATED_OPERATORS = {"is not", "!=", "not equal", "not equals"}
+LOCAL_AGGREGATE_PATTERN = re.compile(
+    r'^(?:calculate\s+|compute\s+|get\s+)?(?:the\s+)?(?P<aggregate>sum|total|average|mean|min|minimum|max|maximum)\s+(?:value\s+)?(?:of\s+)?(?P<column>.+)$',
+    re.IGNORECASE
+)
+LOCAL_TEXT_TRANSFORM_PATTERN = re.compile(
+    r'^(?P<transform>uppercase|upper-case|upper\s+case|lowercase|lower-case|lower\s+case|trim|strip|title-case|title\s+case)\s+(?:all\s+)?(?:the\s+)?(?:values\s+(?:in|of)\s+)?(?P<column>.+)$',
+    re.IGNORECASE
+)
+LOCAL_CONVERT_PATTERN = re.compile(
+    r'^(?:convert|change|make|turn)\s+(?:all\s+)?(?:the\s+)?(?:values\s+(?:in|of)\s+)?(?P<column>.+?)\s+(?:to|into)\s+(?P<transform>uppercase|upper\s+case|lowercase|lower\s+case|title\s+case)$',
+    re.IGNORECASE
+)
+LOCAL_AGGREGATE_ALIASES = {"sum": "sum", "total": "sum", "average": "mean", "mean": "mean", "min": "min", "minimum": "min", "max": "max", "maximum": "max"}
+
+
+def resolve_single_column(column_text: str, column_letters: dict):
+    """Resolves a column reference such as "column C", "col C", "the 'Price' column" or "Price" to an actual column name (or None)."""
+    text = column_text.strip().rstrip('.?!').strip()
+    text = re.sub(r'^(?:the\s+)', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'\s+column$', '', text, flags=re.IGNORECASE)
+
+    letter_match = re.fullmatch(r'(?i:columns?|cols?)\s+([A-Z]{1,3})', text)
+    if letter_match:
+        letter_to_column = {letter: col_name for col_name, letter in column_letters.items()}
+        return letter_to_column.get(letter_match.group(1))
+
+    name = re.sub(r'^(?i:column|col)\s+', '', text).strip().strip('\'"`')
+    for col_name in column_letters:
+        if str(col_name).strip().lower() == name.lower():
+            return col_name
+    return None
+
+
+def plan_local_command(command: str, column_letters: dict) -> dict | None:
+    """
+    Matches a command against the small grammar of locally executable operations.
+    Returns a plan dict ({"operation", "column", ...}; "rowwise" marks one result per row), or None to fall back to the AI.
+    """
+    text = command.strip().rstrip('.?!').strip()
+
+    match = LOCAL_UNIQUE_PATTERN.match(text)
+    if match:
+        column = resolve_single_column(match.group('column'), column_letters)
+        return {"operation": "unique", "column": column, "rowwise": False} if column is not None else None
+
+    match = LOCAL_COUNT_PATTERN.match(text)
+    if match:
+        if not match.group('column'):
+            return {"operation": "count", "column": None, "rowwise": False}
+        column = resolve_single_column(match.group('column'), column_letters)
+        if column is None:
+            return None
+        operator = re.sub(r'\s+', ' ', match.group('operator').lower())
+        value = match.group('value').strip()
+        quoted_value = LOCAL_COUNT_QUOTED_VALUE_PATTERN.fullmatch(value)
+        if quoted_value:
+            value = quoted_value.group(2)
+        elif LOCAL_COUNT_COMPOUND_VALUE_PATTERN.search(value):
+            return None
+        elif value.lower() in LOCAL_COUNT_EMPTY_VALUES:
+            if operator not in LOCAL_COUNT_NEGATED_OPERATORS and operator not in ("is", "=", "==", "equal", "equals"):
+                return None
+            return {"operation": "count", "column": column, "operator": operator, "value": value, "empty": True, "rowwise": False}
+        return {"operation": "count", "column": column, "operator": operator, "value": value, "rowwise": False}
+
+    match = LOCAL_AGGREGATE_PATTERN.match(text)
+    if match:
+        column = resolve_single_column(match.group('column'), column_letters)
+        aggregate = LOCAL_AGGREGATE_ALIASES[match.group('aggregate').lower()]
+        return {"operation": aggregate, "column": column, "rowwise": False} if column is not None else None
+
+    match = LOCAL_TEXT_TRANSFORM_PATTERN.match(text) or LOCAL_CONVERT_PATTERN.match(text)
+    if match:
+        column = resolve_single_column(match.group('column'), column_letters)
+        transform = re.sub(r'[\s-]+', '', match.group('transform').lower())
+        transform = {"strip": "trim", "titlecase": "title"}.get(transform, transform)
+        return {"operation": transform, "column": column, "rowwise": True} if column is not None else None
+
+    return None
+
+
+def format_local_number(value) -> str:
+    """Formats a numeric result without float noise (e.g. 12.0 -> '12', 0.1 + 0.2 -> '0.3')."""
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return f"{round(value, 10):.10f}".rstrip('0').rstrip('.')
+
+
+def format_local_cell(value) -> str:
+    """Formats a cell for text operations: whole floats lose their '.0' (integer columns with blanks are read as floats), other values are unchanged."""
+    if isinstance(value, (float, np.floating)) and np.isfinite(value) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def count_matching_rows(series: pd.Series, operator: str, value: str, empty: bool = False) -> int:
+    """Counts the values in a column that satisfy a simple comparison, or (with empty=True) that are (not) empty."""
+    if empty:
+        blanks = series.isna() | series.map(lambda cell: isinstance(cell, str) and not cell.strip())
+        return int((~blanks if operator in LOCAL_COUNT_NEGATED_OPERATORS else blanks).sum())
+
+    if operator == "contains":
+        return int(series.dropna().map(format_local_cell).str.contains(value, case=False, regex=False).sum())
+
+    numeric_value = pd.to_numeric(pd.Series([value]), errors='coerce').iloc[0]
+    if operator in (">", "<", ">=", "<="):
+        numbers = pd.to_numeric(series, errors='coerce')
+        comparisons = {">": numbers.gt, "<": numbers.lt, ">=": numbers.ge, "<=": numbers.le}
+        return int(comparisons[operator](numeric_value).sum()) if pd.notna(numeric_value) else 0
+
+    if pd.notna(numeric_value):
+        # Compare numerically where the cell is numeric, otherwise as text
+        numbers = pd.to_numeric(series, errors='coerce')
+        matches = numbers.eq(numeric_value) | series.astype(str).str.strip().str.lower().eq(value.lower())
+    else:
+        matches = series.notna() & series.astype(str).str.strip().str.lower().eq(value.lower())
+    if operator in LOCAL_COUNT_NEGATED_OPERATORS:
+        matches = series.notna() & ~matches
+    return int(matches.sum())
+
+
+def run_local_plan(plan: dict, df: pd.DataFrame) -> tuple | None:
+    """
+    Executes a local plan on the DataFrame. Returns (ai_response_text, parsed_results) in the same Markdown list
+    format the AI produces, or None if the data does not suit the operation (the caller then falls back to the AI).
+    """
+    operation = plan["operation"]
+    series = df[plan["column"]] if plan["column"] is not None else None
+
+    if operation == "unique":
+        values = series.dropna().map(format_local_cell).str.strip()
+        results = values[values != ""].drop_duplicates().tolist()
+    elif operation == "count":
+        count = df.shape[0] if series is None else count_matching_rows(series, plan["operator"], plan["value"], plan.get("empty", False))
+        results = [str(count)]
+    elif operation in ("sum", "mean", "min", "max"):
+        numbers = pd.to_numeric(series, errors='coerce').dropna()
+        if numbers.empty:
+            return None
+        results = [format_local_number(getattr(numbers, operation)())]
+    else:
+        text_values = series.map(format_local_cell, na_action='ignore')
+        transformed = {"uppercase": text_values.str.upper, "lowercase": text_values.str.lower,
+                       "trim": text_values.str.strip, "title": text_values.str.title}[operation]()
+        results = transformed.astype(object).where(series.notna(), None).tolist()
+
+    print(f"DEBUG: Command handled locally ({operation} on {plan['column']!r}), {len(results)} result(s), no AI call made.")
+    ai_response_text = "\n".join(f"* {item}" if item is not None else "*" for item in results)
+    return ai_response_text, results
+
+
+def prepare_prompt_dataframe(df: pd.DataFrame, command: str, output_mode: str) -> tuple:
+    """
+    Reduces a sheet to what the AI needs to see: the referenced columns and, in new-column mode, only distinct input rows.
+    Returns (prompt_df, column_letters, row_to_unique); row_to_unique is None unless rows were deduplicated.
+    """
+    # Only the columns referenced by the command are sent to the AI, keeping their original column letters
+    column_letters = build_column_letter_map(df.columns)
+    prompt_df = project_dataframe_for_command(df, command, column_letters)
+
+    # New-column values depend only on the referenced columns, so repeated input rows are prompted once
+    row_to_unique = None
+    if output_mode == "new_column_original_sheet":
+        unique_df, row_to_unique = dedupe_rows_for_prompt(prompt_df)
+        if unique_df.shape[0] < prompt_df.shape[0]:
+            print(f"DEBUG: Deduplicated {prompt_df.shape[0]} rows to {unique_df.shape[0]} distinct inputs for the AI.")
+            prompt_df = unique_df
+        else:
+            row_to_unique = None
+    return prompt_df, column_letters, row_to_unique
+
+
+def run_ai_command(df: pd.DataFrame, command: str, output_mode: str, results_callback=None) -> tuple:
+    """
+    Runs a command against a sheet: locally if the command router recognises it, otherwise through Gemini
+    (projected, deduplicated and chunked as needed). Returns (ai_response_text, parsed_results, chunk_stats).
+    results_callback, if given, is called as results_callback(index, values) with the results as they become known
+    (a single prompt is then streamed from Gemini); in new-column mode index is the row index of values[0].
+    """
+    local_plan = plan_local_command(command, build_column_letter_map(df.columns))
+    if local_plan:
+        with stage_span("local_command"):
+            local_outcome = run_local_plan(local_plan, df)
+        if local_outcome:
+            if results_callback:
+                results_callback(0, local_outcome[1])
+            return local_outcome[0], local_outcome[1], None
+
+    with stage_span("prepare_prompt_data"):
+        prompt_df, column_letters, row_to_unique = prepare_prompt_dataframe(df, command, output_mode)
+
+    # Per-row commands on large sheets are split into chunks and processed concurrently.
+    # Other modes need the whole sheet in one prompt (e.g. de-duplication, totals).
+    chunk_stats = None
+    data_chunks = split_dataframe_into_chunks(prompt_df) if output_mode == "new_column_original_sheet" else [prompt_df]
+    chunk_callback = align_results_to_rows(results_callback, row_to_unique) if results_callback else None
+
+    if len(data_chunks) > 1:
+        print(f"DEBUG: Sheet split into {len(data_chunks)} chunks for concurrent AI processing.")
+        ai_response_text, parsed_results, chunk_stats = process_ai_command_chunked(data_chunks, command, column_letters, chunk_callback)
+    elif chunk_callback:
+        ai_response_text, parsed_results = stream_ai_command(prompt_df, command, column_letters, lambda item: chunk_callback([item]))
+    else:
+        # Core change: AI is always instructed to output a Markdown list.
+        # parse_ai_response_to_list will now always expect a Markdown list.
+        ai_response_text = process_ai_command(prompt_df, command, column_letters) # No longer pass output_mode
+        with stage_span("parse_response"):
+            parsed_results = parse_ai_response_to_list(ai_response_text) # No longer pass is_markdown_list_expected
+
+    if row_to_unique is not None:
+        parsed_results, ai_response_text = expand_deduplicated_results(parsed_results, row_to_unique, prompt_df.shape[0], ai_response_text)
+
+    return ai_response_text, parsed_results, chunk_stats
+
+
+def run_excel_pipeline(filepath_original: str, original_filename: str, command: str, sheet_name: str, output_mode: str,
+                       new_column_name: str, host_url: str, progress_callback=None, session_id: str | None = None) -> dict:
+    """
+    Runs the full processing pipeline on a saved Excel file: read the sheet, run the AI command, write the results.
+    Returns the response data for the client, including a per-stage "timings" breakdown.
+    Exceptions are left to the caller (see describe_pipeline_error).
+    progress_callback, if given, is called as progress_callback(fraction, stage) as the pipeline advances.
+    With a session_id the sheet is taken from the session's parsed-sheet cache instead of being parsed from filepath_original.
+    """
+    with track_pipeline_run(output_mode) as pipeline_metrics:
+        response_data = execute_excel_pipeline(filepath_original, original_filename, command, sheet_name, output_mode,
+                                               new_column_name, host_url, progress_callback, session_id)
+    response_data["timings"] = pipeline_metrics.summary()
+    print(f"DEBUG: Pipeline timings: {response_data['timings']}")
+    return response_data
+
+
+def execute_excel_pipeline(filepath_original: str, original_filename: str, command: str, sheet_name: str, output_mode: str,
+                           new_column_name: str, host_url: str, progress_callback=None, session_id: str | None = None,
+                           preview_callback=None, results_callback=None) -> dict:
+    """
+    Pipeline body of run_excel_pipeline, shared with /upload_stream, which passes callbacks to report results early:
+    preview_callback(data_preview) once the sheet's first rows are read, and results_callback(index, values) as results
+    become known (see run_ai_command).
+    """
+    def report_progress(fraction: float, stage: str):
+        if progress_callback:
+            progress_callback(fraction, stage)
+
+    report_progress(0.05, "reading")
+
+    # Large sheets in new-column mode are streamed from the workbook instead of being loaded into one DataFrame
+    if output_mode == "new_column_original_sheet" and filepath_original.lower().endswith('.xlsx'):
+        workbook, worksheet, actual_sheet_name_read = open_sheet_for_streaming(filepath_original, sheet_name)
+        try:
+            if is_streamed_sheet(worksheet):
+                return run_streaming_new_column_pipeline(workbook, worksheet, filepath_original, original_filename, actual_sheet_name_read,
+                                                         command, new_column_name, host_url, report_progress, preview_callback, results_callback)
+        finally:
+            workbook.close()
+
+    with stage_span("read_excel"):
+        if session_id:
+            df, actual_sheet_name_read = read_session_sheet(session_id, sheet_name)
+        else:
+            df, actual_sheet_name_read = read_excel_sheet(filepath_original, sheet_name)
+
+        # --- New Log: Display actual column names read by Pandas ---
+        print(f"\n--- Actual Column Names Read by Pandas ---\n{df.columns.tolist()}\n--- End of Actual Column Names ---")
+        # -----------------------------------------------------------
+
+        original_df_rows = df.shape[0]
+        df = df.replace({np.nan: None}) # Replace NaN with None for consistent AI input
+
+    print(df.head())
+    if preview_callback:
+        preview_callback(df.head().to_dict(orient='records'))
+
+    report_progress(0.2, "processing")
+    ai_response_text, parsed_results, chunk_stats = run_ai_command(df, command, output_mode, results_callback)
+
+    print(f"\n--- Raw AI Response ---\n{ai_response_text}\n--- End of Raw AI Response ---") # Prominently print raw AI response
+    print(f"DEBUG: Parsed AI list content: {parsed_results}") # Log parsed AI results
+    print(f"DEBUG: Parsed AI list length: {len(parsed_results)}, Original data rows: {original_df_rows}") # Log lengths
+
+    report_progress(0.8, "writing")
+    with stage_span("write_results"):
+        ai_response_text, download_url = write_pipeline_results(df, parsed_results, ai_response_text, filepath_original, original_filename,
+                                                                actual_sheet_name_read, output_mode, new_column_name, host_url)
+
+    response_data = {
+        "message": "File upload, reading, and AI processing successful!",
+        "filename": original_filename,
+        "data_preview": df.head().to_dict(orient='records'),
+        "ai_response": ai_response_text,
+        "download_url": download_url
+    }
+    if chunk_stats is not None:
+        response_data["chunk_stats"] = chunk_stats
+    return response_data
 
 
 @app.route('/')
@@ -184,245 +1804,1101 @@ def home():
     """Home route or health check."""
     return jsonify({"message": "Welcome to the Excel AI Processor backend!"}), 200
 
+@app.route('/metrics')
+def metrics():
+    """Exports pipeline stage timings, memory, token and cache metrics in the Prometheus text format."""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Reports response cache hit/miss statistics and size."""
+    return jsonify({"enabled": RESPONSE_CACHE_ENABLED, **response_cache.stats()}), 200
+
+OUTPUT_MODES = ("new_sheet_original_file", "new_excel_file", "new_column_original_sheet")
+
+
+def read_processing_form() -> tuple:
+    """
+    Reads the uploaded file and processing options from the current request.
+    Returns (form, error_message); error_message is None when the request is valid.
+    """
+    session_id = request.form.get('session_id', '').strip()
+    if 'file' not in request.files and not session_id:
+        return None, "No file part in the request."
+
+    form = {
+        "file": request.files.get('file'),
+        "session_id": session_id,
+        "command": request.form.get('command', '').strip(),
+        "sheet_name": request.form.get('sheet_name', '').strip(),
+        "output_mode": request.form.get('output_mode', 'new_sheet_original_file'),
+        "new_column_name": request.form.get('new_column_name', '').strip(),
+    }
+
+    print(f"DEBUG: Backend received command from frontend: '{form['command']}', Output Mode: {form['output_mode']}, New Column Name: '{form['new_column_name']}'")
+
+    if not session_id and form["file"].filename == '':
+        return None, "No file selected."
+
+    if not form["command"]:
+        return None, "Please provide an AI command!"
+
+    if form["output_mode"] not in OUTPUT_MODES:
+        return None, f"Unknown output mode. Use one of: {', '.join(OUTPUT_MODES)}."
+
+    if form["output_mode"] == 'new_column_original_sheet' and not form["new_column_name"]:
+        return None, "When adding a new column, please specify its name!"
+
+    if not session_id and not allowed_file(form["file"].filename):
+        return None, "File type not allowed. Only .xlsx and .xls files are accepted."
+
+    return form, None
+
+
+def save_uploaded_file(file) -> tuple:
+    """
+    Saves an uploaded file under a sanitized name in a new request directory of UPLOAD_FOLDER.
+    Returns (filepath, error_message); error_message is None on success.
+    """
+    filepath_original = os.path.join(create_request_dir(app.config['UPLOAD_FOLDER']), safe_upload_filename(file.filename))
+    try:
+        with atomic_write_path(filepath_original) as temp_path:
+            file.save(temp_path) # Save the original file
+    except OSError as e:
+        print(f"ERROR: Could not save uploaded file {filepath_original}: {e}")
+        return None, f"Could not save the uploaded file. Please try again. Detailed error: {e}"
+    print(f"Original file saved to: {filepath_original}")
+    return filepath_original, None
+
+
+def prepare_source_file(form: dict) -> tuple:
+    """
+    Returns (filepath, filename, error_message) for the workbook a request processes:
+    the uploaded file, or the session workbook when the request references a session_id.
+    """
+    if form["session_id"]:
+        return checkout_session_workbook(form["session_id"])
+    filepath_original, error_message = save_uploaded_file(form["file"])
+    return filepath_original, os.path.basename(filepath_original) if filepath_original else None, error_message
+
+
+def describe_pipeline_error(e: Exception, sheet_name: str) -> tuple:
+    """Turns a pipeline exception into a user-facing (error_message, http_status)."""
+    print(f"ERROR: An error occurred while processing file or AI command: {e}")
+    if "No sheet named" in str(e):
+        return f"Could not find sheet named '{sheet_name}'. Please check the name.", 400
+    elif "Worksheet named" in str(e) and "not found" in str(e):
+        return f"Could not find sheet named '{sheet_name}'. Please check the name.", 400
+    else:
+        return f"Processing failed: {str(e)}", 500
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handles Excel file upload and AI command processing."""
     print("Received file upload and processing request...")
 
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request."}), 400
+    form, error_message = read_processing_form()
+    if error_message:
+        return jsonify({"error": error_message}), 400
 
-    file = request.files['file']
-    command = request.form.get('command', '').strip()
-    sheet_name = request.form.get('sheet_name', '').strip()
-    output_mode = request.form.get('output_mode', 'new_sheet_original_file')
-    new_column_name = request.form.get('new_column_name', '').strip()
+    filepath_original, original_filename, error_message = prepare_source_file(form)
+    if error_message:
+        return jsonify({"error": error_message}), 400
 
-    print(f"DEBUG: Backend received command from frontend: '{command}', Output Mode: {output_mode}, New Column Name: '{new_column_name}'")
+    try:
+        response_data = run_excel_pipeline(filepath_original, original_filename, form["command"], form["sheet_name"],
+                                           form["output_mode"], form["new_column_name"], request.host_url.rstrip('/'),
+                                           session_id=form["session_id"] or None)
+        return Response(json.dumps(response_data, ensure_ascii=False), mimetype='application/json')
 
-    if file.filename == '':
-        return jsonify({"error": "No file selected."}), 400
+    except Exception as e:
+        error_message, status_code = describe_pipeline_error(e, form["sheet_name"])
+        return jsonify({"error": error_message}), status_code
 
-    if not command:
-        return jsonify({"error": "Please provide an AI command!"}), 400
 
-    if output_mode == 'new_column_original_sheet' and not new_column_name:
-        return jsonify({"error": "When adding a new column, please specify its name!"}), 400
+def format_sse(event: str, data) -> str:
+    """Formats one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def iter_pipeline_events(run):
+    """
+    Runs run(emit) in a background thread (in a copy of the current context, so its stages are recorded in the current
+    pipeline metrics) and yields the Server-Sent Events it emits with emit(event, data) as they arrive. Returns run's result.
+    """
+    events = queue.Queue()
+    outcome = {}
+
+    def run_in_thread():
+        try:
+            outcome["result"] = run(lambda event, data: events.put((event, data)))
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            events.put(None)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run_in_thread,), name="stream-events", daemon=True).start()
+    while (event := events.get()) is not None:
+        yield format_sse(*event)
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+@app.route('/upload_stream', methods=['POST'])
+def upload_file_stream():
+    """
+    Same processing as /upload (execute_excel_pipeline), but the response is a Server-Sent Events stream:
+    'preview' with the data preview, 'items' events with results as they become known ({"index": position of the
+    first value, "values": [...]}: parsed list items as Gemini generates them, or one event per finished chunk or batch
+    of a large sheet), then 'done' with the same payload /upload returns (or 'error').
+    In new-column mode index is a row index; deduplicated rows receive their results together with the row they repeat.
+    """
+    print("Received streaming file upload and processing request...")
+
+    form, error_message = read_processing_form()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    filepath_original, original_filename, error_message = prepare_source_file(form)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    host_url = request.host_url.rstrip('/')
+
+    def run_pipeline(emit):
+        return execute_excel_pipeline(
+            filepath_original, original_filename, form["command"], form["sheet_name"], form["output_mode"], form["new_column_name"],
+            host_url, session_id=form["session_id"] or None,
+            preview_callback=lambda data_preview: emit("preview", {"filename": original_filename, "data_preview": data_preview}),
+            results_callback=lambda index, values: emit("items", {"index": index, "values": values})
+        )
+
+    def generate_events():
+        try:
+            with track_pipeline_run(form["output_mode"]) as pipeline_metrics:
+                response_data = yield from iter_pipeline_events(run_pipeline)
+            yield format_sse("done", {**response_data, "timings": pipeline_metrics.summary()})
+        except Exception as e:
+            error_message, _ = describe_pipeline_error(e, form["sheet_name"])
+            yield format_sse("error", {"error": error_message})
+
+    return Response(stream_with_context(generate_events()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
-    if file and allowed_file(file.filename):
-        original_filename = file.filename
-        filepath_original = os.path.join(app.config['UPLOAD_FOLDER'], original_filename)
+# --- Workbook Sessions ---
+# POST /sessions stores a workbook once under its sha256 content hash. Commands sent with that session_id skip the
+# upload, and each sheet is parsed only once: the DataFrame is cached next to the workbook as an Arrow IPC file
+# (memory-mapped when loaded again) or, without pyarrow, as a pickle.
+# Sessions are evicted least recently used first once SESSION_FOLDER grows beyond SESSION_CACHE_MAX_BYTES.
 
-        # Ensure the file is closed before attempting to remove it (for overwriting)
-        if os.path.exists(filepath_original):
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+_session_lock = threading.Lock()
+
+
+def get_session_dir(session_id: str) -> str | None:
+    """Returns the folder of an existing session, or None if the id is malformed or unknown."""
+    if not SESSION_ID_PATTERN.match(session_id or ''):
+        return None
+    session_path = os.path.join(SESSION_FOLDER, session_id)
+    return session_path if os.path.isdir(session_path) else None
+
+
+def load_session(session_id: str) -> dict | None:
+    """Returns the metadata of a session and marks it as recently used, or None if the session does not exist."""
+    session_path = get_session_dir(session_id)
+    if session_path is None:
+        return None
+    try:
+        with open(os.path.join(session_path, 'session.json'), encoding='utf-8') as f:
+            session = json.load(f)
+        os.utime(session_path) # The folder's modification time is the LRU clock
+    except (OSError, ValueError):
+        return None
+    session["workbook_path"] = os.path.join(session_path, session["workbook"])
+    return session
+
+
+def create_session(file) -> tuple:
+    """
+    Stores an uploaded workbook as a session, or reuses the existing session for identical content.
+    Returns (session, error_message); error_message is None on success.
+    """
+    temp_path = os.path.join(SESSION_FOLDER, f".upload-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    with open(temp_path, 'wb') as temp_file:
+        for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+            digest.update(block)
+            temp_file.write(block)
+    session_id = digest.hexdigest()
+
+    session = load_session(session_id)
+    if session is not None:
+        os.remove(temp_path)
+        print(f"DEBUG: Reusing session {session_id[:12]} for identical upload '{file.filename}'.")
+        return session, None
+
+    session_path = os.path.join(SESSION_FOLDER, session_id)
+    workbook_name = f"workbook.{file.filename.rsplit('.', 1)[1].lower()}"
+    try:
+        with _session_lock:
+            os.makedirs(session_path, exist_ok=True)
+            os.replace(temp_path, os.path.join(session_path, workbook_name))
+        with pd.ExcelFile(os.path.join(session_path, workbook_name)) as xls:
+            sheet_names = xls.sheet_names
+    except Exception as e:
+        print(f"ERROR: Could not create session for '{file.filename}': {e}")
+        shutil.rmtree(session_path, ignore_errors=True)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None, f"Could not read the Excel file: {e}"
+
+    session = {
+        "session_id": session_id,
+        "filename": file.filename,
+        "workbook": workbook_name,
+        "sheet_names": sheet_names,
+        "size_bytes": os.path.getsize(os.path.join(session_path, workbook_name)),
+        "created_at": time.time(),
+    }
+    write_file_atomically(os.path.join(session_path, 'session.json'), json.dumps(session, ensure_ascii=False).encode('utf-8'))
+    print(f"DEBUG: Created session {session_id[:12]} for '{file.filename}' with sheets {sheet_names}.")
+    evict_sessions(keep_session_id=session_id)
+    return load_session(session_id), None
+
+
+def write_file_atomically(path: str, data: bytes):
+    """Writes a file under a temporary name and renames it into place, so readers never see a partial file."""
+    with atomic_write_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+
+
+def session_sheet_cache_path(session_path: str, sheet_name: str, extension: str) -> str:
+    sheet_key = hashlib.sha256(sheet_name.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(session_path, f"sheet-{sheet_key}.{extension}")
+
+
+def read_arrow_sheet(path: str) -> pd.DataFrame:
+    """Loads a cached sheet from an Arrow IPC file through a memory map (the map stays open while its buffers are in use)."""
+    source = pa.memory_map(path, 'r')
+    return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def write_session_sheet_cache(session_path: str, sheet_name: str, df: pd.DataFrame):
+    """Caches a parsed sheet as Arrow IPC, falling back to a pickle for sheets Arrow cannot represent (e.g. mixed-type columns)."""
+    temp_path = os.path.join(session_path, f".sheet-{uuid.uuid4().hex}.tmp")
+    try:
+        if pa is not None and all(isinstance(col_name, str) for col_name in df.columns):
             try:
-                os.remove(filepath_original)
-                print(f"DEBUG: Removed old file {filepath_original}.")
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                os.replace(temp_path, session_sheet_cache_path(session_path, sheet_name, 'arrow'))
+                return
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                print(f"DEBUG: Sheet '{sheet_name}' cannot be cached as Arrow ({e}), caching it as a pickle instead.")
+        df.to_pickle(temp_path)
+        os.replace(temp_path, session_sheet_cache_path(session_path, sheet_name, 'pkl'))
+    except OSError as e:
+        print(f"WARNING: Could not cache sheet '{sheet_name}': {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def read_session_sheet(session_id: str, sheet_name: str) -> tuple:
+    """
+    Session counterpart of read_excel_sheet: returns (DataFrame, actual_sheet_name) for the requested sheet (or the first sheet).
+    The sheet is parsed from the workbook on first use and loaded from the sheet cache afterwards.
+    """
+    session = load_session(session_id)
+    if session is None:
+        raise ValueError("Session not found or expired. Please upload the workbook again.")
+    session_path = os.path.dirname(session["workbook_path"])
+    actual_sheet_name_read = sheet_name if sheet_name and sheet_name in session["sheet_names"] else session["sheet_names"][0]
+
+    cached_formats = [("pkl", pd.read_pickle)] if pa is None else [("arrow", read_arrow_sheet), ("pkl", pd.read_pickle)]
+    for extension, read_cached_sheet in cached_formats:
+        cache_path = session_sheet_cache_path(session_path, actual_sheet_name_read, extension)
+        if os.path.exists(cache_path):
+            try:
+                df = read_cached_sheet(cache_path)
+                print(f"DEBUG: Loaded sheet '{actual_sheet_name_read}' of session {session_id[:12]} from the sheet cache. First 5 rows of data:")
+                return df, actual_sheet_name_read
             except Exception as e:
-                print(f"WARNING: Could not remove old file {filepath_original}: {e}. It might be in use.")
-                return jsonify({"error": f"Could not process file. Please ensure the Excel file is not open or in use, and re-upload. Detailed error: {e}"}), 400
+                print(f"WARNING: Could not load cached sheet {cache_path}: {e}. Parsing the workbook again.")
 
-        file.save(filepath_original) # Save the original file
-        print(f"Original file saved to: {filepath_original}")
+    df, actual_sheet_name_read = read_excel_sheet(session["workbook_path"], actual_sheet_name_read)
+    write_session_sheet_cache(session_path, actual_sheet_name_read, df)
+    evict_sessions(keep_session_id=session_id)
+    return df, actual_sheet_name_read
 
-        try:
-            xls = pd.ExcelFile(filepath_original)
-            if sheet_name and sheet_name in xls.sheet_names:
-                actual_sheet_name_read = sheet_name
-                df = pd.read_excel(xls, sheet_name=actual_sheet_name_read, header=0)
-                print(f"Successfully read sheet '{actual_sheet_name_read}'. First 5 rows of data:")
-            else:
-                actual_sheet_name_read = xls.sheet_names[0]
-                df = pd.read_excel(xls, sheet_name=actual_sheet_name_read, header=0)
-                print(f"No sheet name specified. Defaulting to read the first sheet '{actual_sheet_name_read}'. First 5 rows of data:")
-
-            # --- New Log: Display actual column names read by Pandas ---
-            print(f"\n--- Actual Column Names Read by Pandas ---\n{df.columns.tolist()}\n--- End of Actual Column Names ---")
-            # -----------------------------------------------------------
-
-            original_df_rows = df.shape[0]
-            df = df.replace({np.nan: None}) # Replace NaN with None for consistent AI input
-
-            print(df.head())
-
-            # Core change: AI is always instructed to output a Markdown list.
-            # parse_ai_response_to_list will now always expect a Markdown list.
-            ai_response_text = process_ai_command(df, command) # No longer pass output_mode
-            parsed_results = parse_ai_response_to_list(ai_response_text) # No longer pass is_markdown_list_expected
 
-            print(f"\n--- Raw AI Response ---\n{ai_response_text}\n--- End of Raw AI Response ---") # Prominently print raw AI response
-            print(f"DEBUG: Parsed AI list content: {parsed_results}") # Log parsed AI results
-            print(f"DEBUG: Parsed AI list length: {len(parsed_results)}, Original data rows: {original_df_rows}") # Log lengths
+def folder_size_bytes(path: str) -> int:
+    total_bytes = 0
+    for root, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, name))
+            except OSError: # Removed concurrently
+                pass
+    return total_bytes
+
+
+def evict_sessions(keep_session_id: str | None = None):
+    """Removes least recently used sessions until SESSION_FOLDER fits in SESSION_CACHE_MAX_BYTES."""
+    with _session_lock:
+        sessions = []
+        for name in os.listdir(SESSION_FOLDER):
+            session_path = os.path.join(SESSION_FOLDER, name)
+            if os.path.isdir(session_path):
+                sessions.append((os.path.getmtime(session_path), name, session_path, folder_size_bytes(session_path)))
+        total_bytes = sum(size for _, _, _, size in sessions)
+
+        for _, name, session_path, size in sorted(sessions):
+            if total_bytes <= SESSION_CACHE_MAX_BYTES:
+                break
+            if name == keep_session_id:
+                continue
+            shutil.rmtree(session_path, ignore_errors=True)
+            total_bytes -= size
+            print(f"DEBUG: Evicted session {name[:12]} ({size} bytes).")
+
+
+def checkout_session_workbook(session_id: str) -> tuple:
+    """
+    Returns (filepath, filename, error_message) for processing a session workbook in a new request directory.
+    The workbook is hard-linked there rather than copied: results are only ever written to a temporary file that then
+    replaces the request's link (see atomic_write_path), so the session workbook itself is never modified.
+    """
+    session = load_session(session_id)
+    if session is None:
+        return None, None, "Session not found or expired. Please upload the workbook again."
 
-            download_url = None
+    filepath_original = os.path.join(create_request_dir(app.config['UPLOAD_FOLDER']), safe_upload_filename(session["filename"]))
+    try:
+        os.link(session["workbook_path"], filepath_original)
+    except OSError: # e.g. UPLOAD_FOLDER and SESSION_FOLDER on different file systems
+        shutil.copyfile(session["workbook_path"], filepath_original)
+        print(f"DEBUG: Copied session {session_id[:12]} workbook to {filepath_original}.")
+    return filepath_original, os.path.basename(filepath_original), None
+
+
+def describe_session(session: dict) -> dict:
+    session_path = os.path.dirname(session["workbook_path"])
+    cached_sheets = [name for name in session["sheet_names"]
+                     if any(os.path.exists(session_sheet_cache_path(session_path, name, extension)) for extension in ("arrow", "pkl"))]
+    return {
+        "session_id": session["session_id"],
+        "filename": session["filename"],
+        "sheet_names": session["sheet_names"],
+        "cached_sheets": cached_sheets,
+        "size_bytes": session["size_bytes"],
+    }
+
+
+@app.route('/sessions', methods=['POST'])
+def create_workbook_session():
+    """Uploads a workbook once and returns a session id that later /upload, /upload_stream and /jobs requests can reference."""
+    if 'file' not in request.files or request.files['file'].filename == '':
+        return jsonify({"error": "No file selected."}), 400
+    file = request.files['file']
+    if not allowed_file(file.filename):
+        return jsonify({"error": "File type not allowed. Only .xlsx and .xls files are accepted."}), 400
+
+    session, error_message = create_session(file)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    return jsonify(describe_session(session)), 201
+
+
+@app.route('/sessions/<session_id>', methods=['GET', 'DELETE'])
+def workbook_session(session_id):
+    """Returns a session's sheets and cache state, or deletes the session."""
+    session = load_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found."}), 404
+    if request.method == 'DELETE':
+        with _session_lock:
+            shutil.rmtree(os.path.dirname(session["workbook_path"]), ignore_errors=True)
+        return jsonify({"session_id": session_id, "deleted": True}), 200
+    return jsonify(describe_session(session)), 200
+
+
+# --- Process Pools ---
+# Batch reading/writing and queued jobs run in shared process pools. Workers are spawned rather than forked, so they do not
+# inherit the locks held by this process's background threads. A pool whose worker died (e.g. killed for running out of
+# memory) is broken for good, so it is replaced on the next submission.
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def get_process_pool(name: str, max_workers: int, broken_pool: ProcessPoolExecutor | None = None) -> ProcessPoolExecutor:
+    """Returns the shared process pool called name, creating it on first use or replacing broken_pool if that is the current one."""
+    with _process_pools_lock:
+        pool = _process_pools.get(name)
+        if pool is None or pool is broken_pool:
+            if pool is not None:
+                print(f"WARNING: The {name} process pool is broken (a worker process exited unexpectedly), starting a new one.")
+                pool.shutdown(wait=False, cancel_futures=True)
+            pool = _process_pools[name] = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return pool
+
+
+def submit_to_process_pool(name: str, max_workers: int, fn, *args):
+    """Submits fn(*args) to the shared process pool called name, replacing the pool once if it turns out to be broken."""
+    pool = get_process_pool(name, max_workers)
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        return get_process_pool(name, max_workers, broken_pool=pool).submit(fn, *args)
+
+
+# --- Batch Processing ---
+# One command applied to several sheets of one or many workbooks (POST /batch, or batch.py on the command line).
+# Reading/parsing and writing workbooks is CPU-bound and runs in a process pool; the AI calls are I/O-bound and run in
+# a bounded thread pool, so sheets that are already parsed are sent to Gemini while later workbooks are still being read.
+
+BATCH_OUTPUT_MODES = ("consolidated", "per_file")
+BATCH_SUMMARY_SHEET_NAME = "Batch_Summary"
+EXCEL_SHEET_NAME_INVALID_PATTERN = re.compile(r'[\[\]:*?/\\]')
+
+
+def read_batch_source(source: dict) -> list:
+    """
+    Reads the selected sheets of one batch input. Executed in a batch worker process.
+    source: {"filepath", "filename", "session_id", "sheet_names"}, where sheet_names [] selects the first sheet and ["*"] every sheet.
+    Returns [(sheet_name, DataFrame or None, error_message or None)] in sheet order.
+    """
+    xls = None
+    if source.get("session_id"):
+        session = load_session(source["session_id"])
+        if session is None:
+            return [(None, None, "Session not found or expired. Please upload the workbook again.")]
+        available_sheet_names = session["sheet_names"]
+        read_sheet = lambda name: read_session_sheet(source["session_id"], name)[0]
+    else:
+        xls = pd.ExcelFile(source["filepath"])
+        available_sheet_names = xls.sheet_names
+        read_sheet = lambda name: pd.read_excel(xls, sheet_name=name, header=0)
 
-            if output_mode == "new_column_original_sheet":
-                # Ensure AI output list length is compatible with DataFrame index
-                # If AI is expected to generate a value for each row, but the number of results don't match, issue a warning
-                if len(parsed_results) != original_df_rows:
-                    warning_msg = f"WARNING: AI output count ({len(parsed_results)}) does not match original data rows ({original_df_rows}). Results will be adjusted to fit the new column (may be truncated or padded with blanks)."
-                    print(warning_msg)
-                    ai_response_text += f"\n\nNote: {warning_msg}"
-
-                # Critical final fix: Create an empty Series with the same length as the original DataFrame, then populate with AI results
-                new_column_series = pd.Series(index=df.index, dtype=object) # Create an empty Series with the correct index
-                # Populate the beginning of the new Series with parsed_results
-                # If parsed_results is shorter, the rest will be NaN (blank in Excel)
-                # If parsed_results is longer, it will be truncated
-                new_column_series.iloc[:min(len(parsed_results), original_df_rows)] = parsed_results[:min(len(parsed_results), original_df_rows)]
-                df[new_column_name] = new_column_series # Assign to the new column in DataFrame
-
-                print(f"DEBUG: New column '{new_column_name}' added to DataFrame.")
-                print(f"DEBUG: DataFrame tail (with new column): \n{df.tail()}") # Log DataFrame state
-
-                try:
-                    book = load_workbook(filepath_original)
-
-                    if actual_sheet_name_read in book.sheetnames:
-                        old_sheet_index = book.sheetnames.index(actual_sheet_name_read)
-                        book.remove(book[actual_sheet_name_read])
-                        print(f"DEBUG: Old sheet '{actual_sheet_name_read}' removed from Excel workbook.")
-
-                    temp_excel_buffer = io.BytesIO()
-                    with pd.ExcelWriter(temp_excel_buffer, engine='openpyxl') as writer:
-                        df.to_excel(writer, sheet_name=actual_sheet_name_read, index=False)
-                    temp_excel_buffer.seek(0)
-
-                    new_sheet_book = load_workbook(temp_excel_buffer)
-                    new_sheet = new_sheet_book.active
-
-                    book.add_sheet(new_sheet, index=old_sheet_index if 'old_sheet_index' in locals() else 0)
-                    new_sheet.title = actual_sheet_name_read # Ensure the sheet name is preserved
-
-                    book.save(filepath_original) # Save the modified workbook
-                    print(f"AI processed results added as new column '{new_column_name}' to sheet '{actual_sheet_name_read}' in original file '{original_filename}', preserving other sheets.")
-
-                    host_url = request.host_url.rstrip('/')
-                    download_url = f"{host_url}/download/{original_filename}"
-                    print(f"DEBUG: Generated download URL (pointing to modified original file - new column mode): {download_url}")
-
-                except Exception as writer_e:
-                    print(f"ERROR: Problem writing new column results to original Excel file: {writer_e}")
-                    ai_response_text += f"\n\nERROR: Could not write results as a new column to the original Excel file. Please ensure the file is not in use and re-upload. Detailed error: {writer_e}"
-                    download_url = None
-                    print(f"DEBUG: Failed to write to original Excel file, no download link generated (new column mode). Error: {writer_e}")
-
-            elif output_mode == "new_sheet_original_file":
-                if parsed_results:
-                    output_df = pd.DataFrame(parsed_results, columns=['AI_Processed_Result']) # Column name for the new sheet
-                    modified_excel_path = filepath_original
+    requested_sheet_names = source.get("sheet_names") or []
+    if requested_sheet_names == ["*"]:
+        sheet_names = available_sheet_names
+    else:
+        sheet_names = requested_sheet_names or available_sheet_names[:1]
+
+    sheets = []
+    try:
+        for sheet_name in sheet_names:
+            if sheet_name not in available_sheet_names:
+                sheets.append((sheet_name, None, f"Could not find sheet named '{sheet_name}'. Please check the name."))
+                continue
+            try:
+                sheets.append((sheet_name, read_sheet(sheet_name), None))
+                print(f"DEBUG: Batch read sheet '{sheet_name}' of '{source['filename']}'.")
+            except Exception as e:
+                sheets.append((sheet_name, None, f"Could not read sheet: {e}"))
+    finally:
+        if xls is not None:
+            xls.close()
+    return sheets
+
+
+def process_batch_sheet(df: pd.DataFrame, command: str, new_column_name: str) -> tuple:
+    """
+    Runs the batch command on one sheet. Returns (result_frame, result_count, message); the message explains
+    a missing result frame, or warns about a row-count mismatch in new-column results. With a new_column_name the result frame is the sheet plus the results as that column, otherwise just the result list.
+    """
+    df = df.replace({np.nan: None}) # Replace NaN with None for consistent AI input
+    output_mode = "new_column_original_sheet" if new_column_name else "new_excel_file"
+    ai_response_text, parsed_results, _ = run_ai_command(df, command, output_mode)
+    if not parsed_results:
+        return None, 0, ai_response_text.strip().split('\n')[0] or "AI response could not be parsed into a list."
+
+    if not new_column_name:
+        return pd.DataFrame(parsed_results, columns=['AI_Processed_Result']), len(parsed_results), None
+
+    # Same alignment as new-column mode: results are truncated or padded with blanks to the sheet's row count
+    result_frame = df.copy()
+    new_column_series = pd.Series(index=result_frame.index, dtype=object)
+    matched_rows = min(len(parsed_results), result_frame.shape[0])
+    new_column_series.iloc[:matched_rows] = parsed_results[:matched_rows]
+    result_frame[new_column_name] = new_column_series
+    warning_message = None
+    if len(parsed_results) != result_frame.shape[0]:
+        warning_message = f"AI output count ({len(parsed_results)}) does not match original data rows ({result_frame.shape[0]}); results were truncated or padded with blanks."
+    return result_frame, len(parsed_results), warning_message
+
+
+def make_excel_sheet_name(name: str, used_names: set) -> str:
+    """Returns a valid, unused Excel sheet name (at most 31 characters, no []:*?/\\) and records it in used_names."""
+    base_name = EXCEL_SHEET_NAME_INVALID_PATTERN.sub('_', name).strip("'") or "Sheet"
+    sheet_name = base_name[:31]
+    suffix = 2
+    while sheet_name.lower() in used_names:
+        sheet_name = f"{base_name[:31 - len(str(suffix)) - 1]}~{suffix}"
+        suffix += 1
+    used_names.add(sheet_name.lower())
+    return sheet_name
+
+
+def make_per_file_output_names(filenames: list, batch_label: str) -> list:
+    """Names the per-file result workbooks in input order; inputs with the same base name (jan/report.xlsx, feb/report.xlsx) get '_2', '_3' suffixes."""
+    used_stems = set()
+    output_names = []
+    for filename in filenames:
+        base_stem = secure_filename(os.path.splitext(os.path.basename(filename))[0]) or "workbook"
+        file_stem = base_stem
+        suffix = 2
+        while file_stem.lower() in used_stems:
+            file_stem = f"{base_stem}_{suffix}"
+            suffix += 1
+        used_stems.add(file_stem.lower())
+        output_names.append(f"{file_stem}_ai_result_{batch_label}.xlsx")
+    return output_names
+
+
+def write_batch_workbook(output_path: str, sheets: list):
+    """Writes [(sheet_name, DataFrame)] to a new workbook via a temporary file. Executed in a batch worker process."""
+    with atomic_write_path(output_path) as temp_path:
+        with pd.ExcelWriter(temp_path, engine='openpyxl') as writer:
+            for sheet_name, frame in sheets:
+                frame.to_excel(writer, sheet_name=sheet_name, index=False)
+    print(f"DEBUG: Batch results written to {output_path}.")
+
+
+def submit_batch_task(fn, *args):
+    return submit_to_process_pool("batch", BATCH_PROCESS_WORKERS, fn, *args)
+
+
+def run_batch(sources: list, command: str, batch_output: str = "consolidated", new_column_name: str = "", output_folder: str | None = None) -> dict:
+    """
+    Applies one command to every selected sheet of every source (see read_batch_source) and writes the results to
+    output_folder (a new request directory in DOWNLOAD_FOLDER by default): one workbook with a sheet per input sheet plus a summary ("consolidated"),
+    or one workbook per input file ("per_file").
+    Returns {"items": one entry per sheet in input order, "outputs": written file names, "timings": ...}.
+    """
+    output_folder = output_folder or create_request_dir(app.config['DOWNLOAD_FOLDER'])
+    batch_label = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    source_items = [[] for _ in sources]
+    outstanding_sheets = [0] * len(sources)
+    per_file_output_names = make_per_file_output_names([source["filename"] for source in sources], batch_label)
+    write_futures = {}
+
+    def submit_write(output_filename: str, sheets: list):
+        future = submit_batch_task(write_batch_workbook, os.path.join(output_folder, output_filename), sheets)
+        write_futures[future] = output_filename
+
+    def submit_file_output(source_index: int):
+        used_names = set()
+        sheets = []
+        for item in source_items[source_index]:
+            if item.get("frame") is not None:
+                item["output_sheet"] = make_excel_sheet_name(item["sheet"], used_names)
+                sheets.append((item["output_sheet"], item.pop("frame")))
+        if sheets:
+            output_filename = per_file_output_names[source_index]
+            for item in source_items[source_index]:
+                item["output_file"] = output_filename if item.get("output_sheet") else None
+            submit_write(output_filename, sheets)
+
+    print(f"DEBUG: Batch {batch_label}: {len(sources)} file(s), output '{batch_output}', command '{command}'.")
+    with track_pipeline_run("batch") as pipeline_metrics, ThreadPoolExecutor(max_workers=BATCH_AI_WORKERS) as ai_executor:
+        pending = {submit_batch_task(read_batch_source, source): ("read", source_index) for source_index, source in enumerate(sources)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, target = pending.pop(future)
+                if kind == "read":
+                    source_index = target
                     try:
-                        with pd.ExcelWriter(modified_excel_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                            output_df.to_excel(writer, sheet_name="AI_Results", index=False) # Fixed sheet name
-                            print(f"AI processed results written to 'AI_Results' sheet in original file '{original_filename}'.")
-
-                        host_url = request.host_url.rstrip('/')
-                        download_url = f"{host_url}/download/{original_filename}"
-                        print(f"DEBUG: Generated download URL (pointing to modified original file - new sheet mode): {download_url}")
-                    except Exception as writer_e:
-                        print(f"ERROR: Problem writing results to original Excel file (new sheet mode): {writer_e}")
-                        ai_response_text += f"\n\nERROR: Could not write results to original Excel file. Please ensure the file is not in use and re-upload. Detailed error: {writer_e}"
-                        download_url = None
-                        print(f"DEBUG: Failed to write to original Excel file, no download link generated (new sheet mode). Error: {writer_e}")
+                        sheets = future.result()
+                    except Exception as e:
+                        sheets = [(None, None, f"Could not read the Excel file: {e}")]
+                    for sheet_name, df, error_message in sheets:
+                        item = {"file": sources[source_index]["filename"], "sheet": sheet_name, "rows": None, "results": 0,
+                                "output_file": None, "output_sheet": None, "error": error_message, "warning": None, "source_index": source_index}
+                        source_items[source_index].append(item)
+                        if df is not None:
+                            item["rows"] = df.shape[0]
+                            outstanding_sheets[source_index] += 1
+                            # Copied contexts let the AI stages report into this batch's timings
+                            ai_future = ai_executor.submit(contextvars.copy_context().run, process_batch_sheet, df, command, new_column_name)
+                            pending[ai_future] = ("ai", item)
                 else:
-                    print("DEBUG: AI response could not be parsed into a list, no downloadable Excel file generated (new sheet mode).")
-                    ai_response_text += "\n\nNote: AI response could not be parsed into a list, unable to generate result Excel file."
-                    download_url = None
-
-            elif output_mode == "new_excel_file":
-                if parsed_results:
-                    output_df = pd.DataFrame(parsed_results, columns=['AI_Processed_Result']) # Column name for the new file
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    output_filename_new = f"ai_result_{timestamp}.xlsx"
-                    output_filepath_new = os.path.join(app.config['DOWNLOAD_FOLDER'], output_filename_new)
-
-                    output_df.to_excel(output_filepath_new, index=False)
-                    print(f"AI processed results saved as new Excel file: {output_filepath_new}")
-
-                    host_url = request.host_url.rstrip('/')
-                    download_url = f"{host_url}/download_new/{output_filename_new}"
-                    print(f"DEBUG: Generated download URL (pointing to new file): {download_url}")
-                else:
-                    print("DEBUG: AI response could not be parsed into a list, no downloadable Excel file generated (new file mode).")
-                    ai_response_text += "\n\nNote: AI response could not be parsed into a list, unable to generate result Excel file."
-                    download_url = None
+                    item = target
+                    source_index = item["source_index"]
+                    outstanding_sheets[source_index] -= 1
+                    try:
+                        item["frame"], item["results"], message = future.result()
+                        item["error" if item["frame"] is None else "warning"] = message
+                    except Exception as e:
+                        print(f"ERROR: Batch command failed on sheet '{item['sheet']}' of '{item['file']}': {e}")
+                        item["error"] = f"Processing failed: {e}"
+
+                # A finished file is written right away in per-file mode, so its results do not stay in memory
+                if batch_output == "per_file" and outstanding_sheets[source_index] == 0:
+                    submit_file_output(source_index)
+
+        items = [item for items in source_items for item in items]
+        if batch_output == "consolidated":
+            used_names = {BATCH_SUMMARY_SHEET_NAME.lower()}
+            output_filename = f"batch_result_{batch_label}.xlsx"
+            sheets = []
+            for item in items:
+                if item.get("frame") is not None:
+                    file_stem = os.path.splitext(item["file"])[0]
+                    item["output_sheet"] = make_excel_sheet_name(f"{file_stem}-{item['sheet']}", used_names)
+                    item["output_file"] = output_filename
+                    sheets.append((item["output_sheet"], item.pop("frame")))
+            summary = pd.DataFrame([{"File": item["file"], "Sheet": item["sheet"], "Rows": item["rows"], "Results": item["results"],
+                                     "Result Sheet": item["output_sheet"], "Error": item["error"] or item["warning"]} for item in items])
+            if sheets:
+                submit_write(output_filename, [(BATCH_SUMMARY_SHEET_NAME, summary)] + sheets)
+
+        outputs = []
+        for future in write_futures:
+            try:
+                future.result()
+                outputs.append(write_futures[future])
+            except Exception as e:
+                print(f"ERROR: Could not write batch output {write_futures[future]}: {e}")
+                for item in items:
+                    if item["output_file"] == write_futures[future]:
+                        item["output_file"], item["output_sheet"] = None, None
+                        item["error"] = f"Could not write results: {e}"
 
-            else: # If output_mode is unknown
-                print(f"ERROR: Unknown output mode: {output_mode}")
-                ai_response_text += "\n\nERROR: Unknown output mode, unable to process download request."
-                download_url = None
+    for item in items:
+        item.pop("source_index", None)
+    print(f"DEBUG: Batch {batch_label} finished: {sum(1 for item in items if item['output_file'])}/{len(items)} sheet(s) written to {outputs}.")
+    return {"items": items, "outputs": outputs, "timings": pipeline_metrics.summary()}
 
-            response_data = {
-                "message": "File upload, reading, and AI processing successful!",
-                "filename": original_filename,
-                "data_preview": df.head().to_dict(orient='records'),
-                "ai_response": ai_response_text,
-                "download_url": download_url
-            }
 
-            # Redirect stdout back to original for JSON serialization logging
-            temp_stdout = sys.stdout
-            sys.stdout = io.StringIO()
+@app.route('/batch', methods=['POST'])
+def batch_upload():
+    """
+    Applies one AI command to several workbooks and sheets in one request.
+    Form fields: files (one or more uploads) and/or session_ids (comma-separated), command, sheet_names (comma-separated,
+    "*" for every sheet, empty for the first sheet), batch_output ("consolidated" or "per_file") and an optional new_column_name.
+    """
+    print("Received batch processing request...")
+    files = [file for file in request.files.getlist('files') + request.files.getlist('file') if file.filename]
+    session_ids = [session_id.strip() for session_id in request.form.get('session_ids', '').split(',') if session_id.strip()]
+    command = request.form.get('command', '').strip()
+    sheet_names = [sheet_name.strip() for sheet_name in request.form.get('sheet_names', '').split(',') if sheet_name.strip()]
+    batch_output = request.form.get('batch_output', 'consolidated')
+    new_column_name = request.form.get('new_column_name', '').strip()
 
-            json_string = json.dumps(response_data, ensure_ascii=False)
+    if not files and not session_ids:
+        return jsonify({"error": "No file selected."}), 400
+    if not command:
+        return jsonify({"error": "Please provide an AI command!"}), 400
+    if batch_output not in BATCH_OUTPUT_MODES:
+        return jsonify({"error": f"Unknown batch output '{batch_output}'. Use one of: {', '.join(BATCH_OUTPUT_MODES)}."}), 400
+    for file in files:
+        if not allowed_file(file.filename):
+            return jsonify({"error": f"File type not allowed for '{file.filename}'. Only .xlsx and .xls files are accepted."}), 400
+
+    sources = []
+    for session_id in session_ids:
+        session = load_session(session_id)
+        if session is None:
+            return jsonify({"error": f"Session {session_id} not found or expired. Please upload the workbook again."}), 400
+        sources.append({"filepath": session["workbook_path"], "filename": session["filename"], "session_id": session_id, "sheet_names": sheet_names})
+    for file in files:
+        filepath_original, error_message = save_uploaded_file(file)
+        if error_message:
+            return jsonify({"error": error_message}), 400
+        sources.append({"filepath": filepath_original, "filename": file.filename, "session_id": None, "sheet_names": sheet_names})
+
+    output_folder = create_request_dir(app.config['DOWNLOAD_FOLDER'])
+    try:
+        batch_result = run_batch(sources, command, batch_output, new_column_name, output_folder)
+    except Exception as e:
+        print(f"ERROR: Batch processing failed: {e}")
+        return jsonify({"error": f"Processing failed: {str(e)}"}), 500
+
+    host_url = request.host_url.rstrip('/')
+    batch_result["download_urls"] = [build_download_url(host_url, os.path.join(output_folder, output_filename)) for output_filename in batch_result["outputs"]]
+    return Response(json.dumps(batch_result, ensure_ascii=False, default=str), mimetype='application/json')
+
+
+# --- Asynchronous Job API ---
+# POST /jobs saves the upload, queues the pipeline on a local process pool and returns a job id right away.
+# Job state lives in SQLite so status and results survive server restarts. Several server processes (e.g. gunicorn
+# workers) can share the store: every server gets a fresh instance id at startup and heartbeats it into the store, each
+# job records the instance id of the server that owns it, and a worker claims a queued job atomically before running it.
+# Jobs whose owner has stopped heartbeating (it exited or crashed) are adopted by a live server and run again.
+
+SERVER_INSTANCE_ID = uuid.uuid4().hex  # Differs in every server start (and in pool workers, which are given the owner id explicitly)
+
+
+def _jobs_connect():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_job_store():
+    """Creates the jobs and servers tables if they do not exist yet."""
+    with _jobs_connect() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, progress REAL NOT NULL, stage TEXT, "
+            "params TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner_id TEXT)"
+        )
+        # Job stores created before jobs were owned by server instances
+        if "owner_id" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner_id TEXT")
+        conn.execute("CREATE TABLE IF NOT EXISTS servers (instance_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+
+
+def create_job(params: dict) -> str:
+    """Stores a new queued job owned by this server and returns its id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, progress, stage, params, created_at, updated_at, owner_id) VALUES (?, 'queued', 0, 'queued', ?, ?, ?, ?)",
+            (job_id, json.dumps(params, ensure_ascii=False), now, now, SERVER_INSTANCE_ID)
+        )
+    return job_id
+
+
+def update_job(job_id: str, **fields):
+    """Updates columns of a job record (status, progress, stage, result, error)."""
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    with _jobs_connect() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def get_job(job_id: str) -> dict | None:
+    """Returns a job record with its params and result decoded, or None if the job does not exist."""
+    with _jobs_connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def claim_job(job_id: str, owner_id: str) -> bool:
+    """Atomically moves a queued job owned by owner_id to 'running'. Returns False if it is not queued any more or another server has adopted it."""
+    with _jobs_connect() as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'running', progress = 0, stage = 'starting', updated_at = ? WHERE id = ? AND status = 'queued' AND owner_id = ?",
+            (time.time(), job_id, owner_id)
+        )
+    return cursor.rowcount == 1
+
+
+def run_job(job_id: str, owner_id: str):
+    """Runs a queued job's pipeline unless it cannot be claimed for owner_id. Executed inside a worker process."""
+    if not claim_job(job_id, owner_id):
+        print(f"DEBUG: Job {job_id} is not queued for this server any more, skipping it.")
+        return
+
+    params = get_job(job_id)["params"]
+    try:
+        response_data = run_excel_pipeline(
+            params["filepath"], params["filename"], params["command"], params["sheet_name"], params["output_mode"],
+            params["new_column_name"], params["host_url"],
+            progress_callback=lambda fraction, stage: update_job(job_id, progress=fraction, stage=stage),
+            session_id=params.get("session_id")
+        )
+        update_job(job_id, status="completed", progress=1.0, stage="done", result=json.dumps(response_data, ensure_ascii=False, default=str))
+    except Exception as e:
+        error_message, _ = describe_pipeline_error(e, params["sheet_name"])
+        update_job(job_id, status="failed", stage="failed", error=error_message)
 
-            sys.stdout = temp_stdout # Restore original stdout
 
-            return Response(json_string, mimetype='application/json')
+def submit_job(job_id: str):
+    """
+    Queues a job on the shared job process pool. If the pool breaks before the job finishes (a worker process died),
+    the job is resubmitted to a new pool if it had not started yet, and marked failed if it was running.
+    """
+    future = submit_to_process_pool("jobs", JOB_MAX_WORKERS, run_job, job_id, SERVER_INSTANCE_ID)
+
+    def on_job_done(done_future):
+        if done_future.cancelled() or not isinstance(done_future.exception(), BrokenProcessPool):
+            return
+        job = get_job(job_id)
+        if job is None or job["owner_id"] != SERVER_INSTANCE_ID:
+            return
+        if job["status"] == "queued":
+            print(f"DEBUG: Job pool broke before job {job_id} started, resubmitting it.")
+            submit_job(job_id)
+        elif job["status"] == "running":
+            print(f"ERROR: The worker process running job {job_id} exited unexpectedly.")
+            update_job(job_id, status="failed", stage="failed",
+                       error="Processing failed: the worker process exited unexpectedly (the workbook may be too large to process).")
+
+    future.add_done_callback(on_job_done)
+    return future
+
+
+def send_server_heartbeat():
+    with _jobs_connect() as conn:
+        conn.execute(
+            "INSERT INTO servers (instance_id, heartbeat_at) VALUES (?, ?) ON CONFLICT(instance_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (SERVER_INSTANCE_ID, time.time())
+        )
+
+
+def adopt_orphaned_jobs() -> list:
+    """
+    Takes over the queued and running jobs whose owning server has not heartbeated for JOB_SERVER_TIMEOUT_SECONDS
+    (or never registered), requeuing the running ones, and returns their ids. Each job is taken over with a conditional
+    update, so when several live servers look at the same orphan only one of them gets it.
+    """
+    stale_before = time.time() - JOB_SERVER_TIMEOUT_SECONDS
+    adopted_ids = []
+    with _jobs_connect() as conn:
+        orphaned_jobs = conn.execute(
+            "SELECT jobs.id, jobs.status, jobs.owner_id FROM jobs LEFT JOIN servers ON servers.instance_id = jobs.owner_id "
+            "WHERE jobs.status IN ('queued', 'running') AND (jobs.owner_id IS NULL OR servers.heartbeat_at IS NULL OR servers.heartbeat_at < ?) "
+            "ORDER BY jobs.created_at",
+            (stale_before,)
+        ).fetchall()
+        for job in orphaned_jobs:
+            if job["owner_id"] == SERVER_INSTANCE_ID:
+                continue
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', progress = 0, stage = 'queued', owner_id = ?, updated_at = ? WHERE id = ? AND status = ? AND owner_id IS ?",
+                (SERVER_INSTANCE_ID, time.time(), job["id"], job["status"], job["owner_id"])
+            )
+            if cursor.rowcount == 1:
+                adopted_ids.append(job["id"])
+        conn.execute("DELETE FROM servers WHERE heartbeat_at < ?", (stale_before,))
+    return adopted_ids
+
+
+_job_supervisor_thread = None
+
+
+def start_job_supervisor():
+    """Starts the background thread that heartbeats this server every JOB_HEARTBEAT_SECONDS and runs the jobs it adopts from servers that have exited."""
+    global _job_supervisor_thread
+    if _job_supervisor_thread is not None or not is_main_process():
+        return
+    send_server_heartbeat()
+
+    def run_supervisor():
+        while True:
+            try:
+                send_server_heartbeat()
+                for job_id in adopt_orphaned_jobs():
+                    print(f"DEBUG: Resubmitting unfinished job {job_id} from a server that has exited.")
+                    submit_job(job_id)
+            except Exception as e:
+                print(f"ERROR: Job supervisor failed: {e}")
+            time.sleep(JOB_HEARTBEAT_SECONDS)
 
-        except Exception as e:
-            print(f"ERROR: An error occurred while processing file or AI command: {e}")
-            if "No sheet named" in str(e):
-                return jsonify({"error": f"Could not find sheet named '{sheet_name}'. Please check the name."}), 400
-            elif "Worksheet named" in str(e) and "not found" in str(e):
-                 return jsonify({"error": f"Could not find sheet named '{sheet_name}'. Please check the name."}), 400
-            else:
-                return jsonify({"error": f"Processing failed: {str(e)}"}), 500
-    else:
-        return jsonify({"error": "File type not allowed. Only .xlsx and .xls files are accepted."}), 400
+    _job_supervisor_thread = threading.Thread(target=run_supervisor, name="job-supervisor", daemon=True)
+    _job_supervisor_thread.start()
 
-@app.route('/download/<filename>')
-def download_original_file(filename):
-    """Serves the modified original file for download."""
-    print(f"DEBUG: Received request to download original file: {filename}")
-    full_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
-    if not os.path.exists(full_path):
-        print(f"ERROR: File {full_path} not found in the specified directory.")
-        return jsonify({"error": "File not found."}), 404
+def start_background_services():
+    """Starts the job supervisor and the storage janitor. Called when a server starts, never on import (batch.py, benchmark.py and tests import this module too)."""
+    start_job_supervisor()
+    start_storage_janitor()
 
-    try:
-        with open(full_path, 'rb') as f:
-            file_data = f.read()
 
-        response = Response(file_data, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-        return response
+init_job_store()
+
+
+@app.route('/jobs', methods=['POST'])
+def create_processing_job():
+    """Accepts an upload and AI command, queues the processing and returns the job id immediately."""
+    print("Received job submission request...")
+
+    form, error_message = read_processing_form()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    filepath_original, original_filename, error_message = prepare_source_file(form)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    job_id = create_job({
+        "filepath": filepath_original,
+        "filename": original_filename,
+        "session_id": form["session_id"] or None,
+        "command": form["command"],
+        "sheet_name": form["sheet_name"],
+        "output_mode": form["output_mode"],
+        "new_column_name": form["new_column_name"],
+        "host_url": request.host_url.rstrip('/'),
+    })
+    try:
+        submit_job(job_id)
     except Exception as e:
-        print(f"ERROR: Problem reading and serving original file {filename}: {e}")
-        return jsonify({"error": f"Failed to download file: {e}"}), 500
+        print(f"ERROR: Could not queue job {job_id}: {e}")
+        update_job(job_id, status="failed", stage="failed", error=f"Could not queue the job: {e}")
+        return jsonify({"error": f"Could not queue the job: {e}"}), 500
+    print(f"DEBUG: Job {job_id} queued.")
+
+    host_url = request.host_url.rstrip('/')
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"{host_url}/jobs/{job_id}"}), 202
+
+
+@app.route('/jobs/<job_id>')
+def get_processing_job(job_id):
+    """Returns the status, progress and (once completed) the results and download URL of a job."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+
+    result = job["result"] or {}
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "stage": job["stage"],
+        "download_url": result.get("download_url"),
+        "result": job["result"],
+        "error": job["error"],
+    }), 200
+
+# --- Downloads ---
+# Result files are streamed from disk through send_file (wsgi.file_wrapper, which production servers serve with sendfile),
+# so per-download memory stays constant. Range requests and ETag/If-None-Match revalidation are supported; the ETag is the
+# file's sha256, cached per path and invalidated when the file's size or modification time changes.
+# ?format=csv streams a single sheet as gzip-compressed CSV instead (&sheet=<name>, &compress=0 for plain CSV).
+
+EXCEL_MIMETYPES = {'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xls': 'application/vnd.ms-excel'}
+CSV_EXPORT_FLUSH_ROWS = 1000  # Rows buffered before each CSV piece is compressed and sent
+FILE_ETAG_CACHE_MAX_ENTRIES = 1024
+_file_etag_cache = {}
+_file_etag_lock = threading.Lock()
+
+
+def file_content_etag(path: str) -> str:
+    """Returns the sha256 of a file's content, hashing the file only when it changed since the last call."""
+    stat = os.stat(path)
+    with _file_etag_lock:
+        cached = _file_etag_cache.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    etag = digest.hexdigest()
+    with _file_etag_lock:
+        _file_etag_cache.pop(path, None)
+        if len(_file_etag_cache) >= FILE_ETAG_CACHE_MAX_ENTRIES:
+            _file_etag_cache.pop(next(iter(_file_etag_cache))) # Oldest entry
+        _file_etag_cache[path] = (stat.st_size, stat.st_mtime_ns, etag)
+    return etag
+
+
+def iter_sheet_csv(workbook, worksheet, compress: bool):
+    """Yields a read-only worksheet as CSV bytes (gzip-compressed if requested), a few rows at a time, then closes the workbook."""
+    compressor = zlib.compressobj(wbits=31) if compress else None # wbits=31 writes the gzip format
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take_buffer() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
 
-@app.route('/download_new/<filename>')
-def download_new_file(filename):
-    """Serves the newly created file for download."""
-    print(f"DEBUG: Received request to download new file: {filename}")
-    full_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+    try:
+        for row_number, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
+            writer.writerow(['' if value is None else value for value in row])
+            if row_number % CSV_EXPORT_FLUSH_ROWS == 0:
+                piece = take_buffer()
+                if piece:
+                    yield piece
+        piece = take_buffer() + (compressor.flush() if compressor else b'')
+        if piece:
+            yield piece
+    finally:
+        workbook.close()
 
-    if not os.path.exists(full_path):
-        print(f"ERROR: File {full_path} not found in the specified directory.")
-        return jsonify({"error": "File not found."}), 404
 
+def content_disposition_options(download_name: str) -> dict:
+    """Content-Disposition parameters for an attachment, built like send_file: non-ASCII names get an ASCII fallback plus filename*."""
     try:
-        with open(full_path, 'rb') as f:
-            file_data = f.read()
+        download_name.encode("ascii")
+        return {"filename": download_name}
+    except UnicodeEncodeError:
+        ascii_name = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        return {"filename": ascii_name, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+^`|')}"}
+
+
+def send_sheet_as_csv(full_path: str, filename: str):
+    """Streams one sheet of an .xlsx file as CSV (the requested sheet, else AI_Results if present, else the first sheet)."""
+    if not filename.lower().endswith('.xlsx'):
+        return jsonify({"error": "CSV export is only available for .xlsx files."}), 400
+    sheet_name = request.args.get('sheet', '').strip()
+    compress = request.args.get('compress', '1') != '0'
+
+    workbook = load_workbook(full_path, read_only=True, data_only=True)
+    if sheet_name and sheet_name not in workbook.sheetnames:
+        workbook.close()
+        return jsonify({"error": f"Could not find sheet named '{sheet_name}'. Please check the name."}), 404
+    actual_sheet_name = sheet_name or ("AI_Results" if "AI_Results" in workbook.sheetnames else workbook.sheetnames[0])
+    print(f"DEBUG: Streaming sheet '{actual_sheet_name}' of {filename} as {'gzip-compressed ' if compress else ''}CSV.")
+
+    download_name = f"{os.path.splitext(filename)[0]}_{actual_sheet_name}.csv" + (".gz" if compress else "")
+    response = Response(stream_with_context(iter_sheet_csv(workbook, workbook[actual_sheet_name], compress)),
+                        mimetype='application/gzip' if compress else 'text/csv')
+    # Headers.set quotes the parameters, so sheet names with spaces, ';' or quotes stay one filename
+    response.headers.set("Content-Disposition", "attachment", **content_disposition_options(download_name))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def send_result_file(folder: str, request_id: str, filename: str):
+    """Serves a file from a request directory of one of the result folders as a streaming, Range- and ETag-aware download."""
+    full_path = safe_join(folder, request_id, filename) if REQUEST_ID_PATTERN.match(request_id) else None
+    if full_path is None or not os.path.isfile(full_path):
+        print(f"ERROR: File {filename} not found in {folder}.")
+        return jsonify({"error": "File not found."}), 404
 
-        response = Response(file_data, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    try:
+        if request.args.get('format') == 'csv':
+            return send_sheet_as_csv(full_path, filename)
+
+        extension = filename.rsplit('.', 1)[-1].lower()
+        response = send_file(full_path, mimetype=EXCEL_MIMETYPES.get(extension, 'application/octet-stream'), as_attachment=True,
+                             download_name=filename, conditional=True, etag=file_content_etag(full_path))
+        # Result files are rewritten under the same name, so browsers must revalidate (cheap thanks to the ETag)
+        response.headers["Cache-Control"] = "no-cache"
         return response
     except Exception as e:
-        print(f"ERROR: Problem reading and serving new file {filename}: {e}")
+        print(f"ERROR: Problem serving file {filename}: {e}")
         return jsonify({"error": f"Failed to download file: {e}"}), 500
 
 
+@app.route('/download/<request_id>/<filename>')
+def download_original_file(request_id, filename):
+    """Serves the modified original file for download."""
+    print(f"DEBUG: Received request to download original file: {request_id}/{filename}")
+    return send_result_file(app.config['UPLOAD_FOLDER'], request_id, filename)
+
+
+@app.route('/download_new/<request_id>/<filename>')
+def download_new_file(request_id, filename):
+    """Serves the newly created file for download."""
+    print(f"DEBUG: Received request to download new file: {request_id}/{filename}")
+    return send_result_file(app.config['DOWNLOAD_FOLDER'], request_id, filename)
+
+
 if __name__ == '__main__':
+    # With debug=True the reloader runs the server in a child process; start the background services there only
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services()
     app.run(debug=True, host='127.0.0.1', port=5000)
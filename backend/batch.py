@@ -0,0 +1,76 @@
+# backend/batch.py
+"""
+Command-line batch processing: applies one AI command to every selected sheet of many workbooks.
+
+Usage:
+    python batch.py reports/ --command "Extract the company names in column C" --all-sheets
+    python batch.py a.xlsx b.xlsx --command "Classify column B" --new-column-name Category --output per_file --output-dir results/
+
+Uses the same pipeline as the POST /batch endpoint (see run_batch in app.py); GOOGLE_API_KEY is read from .env.
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+
+import app as xcelerate
+
+
+def collect_workbooks(paths: list, recursive: bool) -> list:
+    """Expands folders into the .xlsx/.xls files they contain; files are taken as given."""
+    workbooks = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*') if recursive else os.path.join(path, '*')
+            workbooks += sorted(found for found in glob.glob(pattern, recursive=recursive)
+                                if os.path.isfile(found) and xcelerate.allowed_file(found) and not os.path.basename(found).startswith('~$'))
+        else:
+            workbooks.append(path)
+    return workbooks
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Apply one Xcelerate AI command to many workbooks and sheets.")
+    parser.add_argument("paths", nargs="+", help="Workbooks (.xlsx/.xls) or folders containing them")
+    parser.add_argument("--command", required=True, help="AI command applied to every sheet")
+    sheet_group = parser.add_mutually_exclusive_group()
+    sheet_group.add_argument("--sheets", nargs="+", default=[], help="Sheet names to process (default: the first sheet)")
+    sheet_group.add_argument("--all-sheets", action="store_true", help="Process every sheet of every workbook")
+    parser.add_argument("--output", choices=xcelerate.BATCH_OUTPUT_MODES, default="consolidated",
+                        help="One workbook for all results, or one per input file")
+    parser.add_argument("--new-column-name", default="", help="Write each sheet with the results as a new column instead of a result list")
+    parser.add_argument("--output-dir", default=".", help="Folder for the result workbooks")
+    parser.add_argument("--recursive", action="store_true", help="Search folders recursively")
+    parser.add_argument("--json", action="store_true", help="Print the batch result as JSON")
+    args = parser.parse_args(argv)
+
+    workbooks = collect_workbooks(args.paths, args.recursive)
+    missing = [path for path in workbooks if not os.path.isfile(path)]
+    if missing:
+        parser.error(f"Not found: {', '.join(missing)}")
+    if not workbooks:
+        parser.error("No .xlsx or .xls files found.")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    sheet_names = ["*"] if args.all_sheets else args.sheets
+    sources = [{"filepath": path, "filename": os.path.basename(path), "session_id": None, "sheet_names": sheet_names} for path in workbooks]
+    batch_result = xcelerate.run_batch(sources, args.command, args.output, args.new_column_name, os.path.abspath(args.output_dir))
+
+    if args.json:
+        print(json.dumps(batch_result, ensure_ascii=False, indent=2, default=str))
+    else:
+        for item in batch_result["items"]:
+            status = f"ERROR: {item['error']}" if item["error"] else f"{item['results']} results -> {item['output_file']} [{item['output_sheet']}]"
+            if item["warning"]:
+                status += f" (WARNING: {item['warning']})"
+            print(f"{item['file']} [{item['sheet']}]: {status}")
+        for output_filename in batch_result["outputs"]:
+            print(f"Wrote {os.path.join(args.output_dir, output_filename)}")
+
+    return 1 if any(item["error"] for item in batch_result["items"]) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
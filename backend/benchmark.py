@@ -0,0 +1,247 @@
+# backend/benchmark.py
+"""
+Offline benchmark for the /upload pipeline.
+
+Generates synthetic .xlsx workbooks, drives the Flask app through its test client with
+genai.GenerativeModel replaced by a deterministic local stub, and reports throughput,
+per-stage latency percentiles and peak memory for each output mode. No network access is needed.
+
+Usage:
+    python benchmark.py --rows 1000 10000 100000 500000 --shapes narrow wide --repeat 3
+    python benchmark.py --json-out results.json
+    python benchmark.py --compare baseline.json --max-regression 0.25   # exits 1 on regression
+"""
+
+import os
+import sys
+import io
+import re
+import json
+import time
+import argparse
+import hashlib
+import shutil
+import tempfile
+import contextlib
+from types import SimpleNamespace
+
+# The app reads its configuration at import time: give it a placeholder key and keep the response cache
+# out of the measurements (repeated runs would otherwise be answered from the cache).
+os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+
+from openpyxl import Workbook
+
+import app as xcelerate
+
+OUTPUT_MODES = xcelerate.OUTPUT_MODES
+SHAPES = {"narrow": 4, "wide": 40}  # Columns per synthetic sheet
+DEFAULT_ROWS = (1000, 10000, 100000)  # Add 500000 with --rows for a full release run
+DEFAULT_COMMAND = "Classify the sentiment of the review text in column B for each row"
+ROW_COUNT_PATTERN = re.compile(r'\((\d+) rows\)')
+
+
+# --- Stub Gemini Backend ---
+
+class StubGenerativeModel:
+    """
+    Deterministic stand-in for genai.GenerativeModel.
+    Answers every prompt with one Markdown list item per data row, after a configurable simulated latency.
+    """
+
+    latency_seconds = 0.05  # Fixed latency per call
+    latency_per_1k_tokens = 0.0  # Additional latency per 1,000 prompt tokens
+    stream_piece_chars = 512  # Size of the pieces returned with stream=True
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream=False):
+        prompt_tokens = xcelerate.estimate_tokens(prompt)
+        time.sleep(self.latency_seconds + self.latency_per_1k_tokens * prompt_tokens / 1000)
+
+        match = ROW_COUNT_PATTERN.search(prompt)
+        rows = int(match.group(1)) if match else 1
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+        text = "\n".join(f"* result-{digest}-{i}" for i in range(rows))
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=xcelerate.estimate_tokens(text))
+
+        if not stream:
+            return self._response(text, usage)
+        pieces = [text[i:i + self.stream_piece_chars] for i in range(0, len(text), self.stream_piece_chars)]
+        return [self._response(piece, usage if i == len(pieces) - 1 else None) for i, piece in enumerate(pieces)]
+
+    @staticmethod
+    def _response(text, usage):
+        part = SimpleNamespace(text=text)
+        candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]))
+        return SimpleNamespace(candidates=[candidate], text=text, usage_metadata=usage)
+
+
+# --- Synthetic Workbooks ---
+
+def make_workbook(path: str, rows: int, columns: int):
+    """Writes a synthetic sheet: an id, a free-text column, and a mix of categorical and numeric columns."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Data")
+    header = ["ID", "Review", "Category", "Amount"] + [f"Field {i}" for i in range(4, columns)]
+    sheet.append(header[:columns])
+    categories = ["Hardware", "Software", "Services", "Support", "Training"]
+    for i in range(rows):
+        row = [i + 1, f"Review number {i} mentions item {i % 997} and delivery {i % 13}", categories[i % len(categories)], round((i * 7919) % 100000 / 100, 2)]
+        row += [f"value {(i * j) % 1000}" if j % 2 else (i * j) % 10007 for j in range(4, columns)]
+        sheet.append(row[:columns])
+    workbook.save(path)
+
+
+def get_workbook(work_dir: str, rows: int, shape: str) -> str:
+    """Returns the path of a synthetic workbook, generating it on first use."""
+    path = os.path.join(work_dir, f"bench_{shape}_{rows}.xlsx")
+    if not os.path.exists(path):
+        print(f"Generating {os.path.basename(path)} ...", file=sys.stderr)
+        make_workbook(path, rows, SHAPES[shape])
+    return path
+
+
+# --- Benchmark Runner ---
+
+def snapshot_files(*folders) -> set:
+    return {os.path.join(folder, name) for folder in folders for name in os.listdir(folder)}
+
+
+def run_once(client, workbook_path: str, output_mode: str, command: str, verbose: bool) -> dict:
+    """Uploads a copy of the workbook once and returns the measured wall time, peak RSS and the app's stage timings."""
+    folders = (xcelerate.UPLOAD_FOLDER, xcelerate.DOWNLOAD_FOLDER)
+    existing_files = snapshot_files(*folders)
+    upload_name = f"bench_{os.getpid()}_{os.path.basename(workbook_path)}"
+    app_output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    span_id = xcelerate.memory_sampler.start_span()
+    started = time.perf_counter()
+    with open(workbook_path, 'rb') as f, app_output:
+        response = client.post('/upload', data={
+            'file': (f, upload_name),
+            'command': command,
+            'output_mode': output_mode,
+            'new_column_name': 'Benchmark Result',
+        }, content_type='multipart/form-data')
+    wall_seconds = time.perf_counter() - started
+    peak_rss_bytes = xcelerate.memory_sampler.end_span(span_id)
+
+    # Uploaded and generated workbooks (in their request directories) are not needed after the run
+    for path in snapshot_files(*folders) - existing_files:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    body = response.get_json(silent=True) or {}
+    if response.status_code != 200:
+        raise RuntimeError(f"{output_mode} on {os.path.basename(workbook_path)} failed with HTTP {response.status_code}: {body.get('error')}")
+    return {"wall_seconds": wall_seconds, "peak_rss_bytes": peak_rss_bytes, "timings": body.get("timings", {})}
+
+
+def percentile(values: list, q: float) -> float:
+    """Linear-interpolated percentile (q in 0..100) of a non-empty list."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(rows: int, shape: str, output_mode: str, runs: list) -> dict:
+    wall = [run["wall_seconds"] for run in runs]
+    stage_names = sorted({stage for run in runs for stage in run["timings"].get("stages", {})})
+    stages = {}
+    for stage in stage_names:
+        seconds = [run["timings"]["stages"].get(stage, {}).get("seconds", 0.0) for run in runs]
+        stages[stage] = {"p50": percentile(seconds, 50), "p95": percentile(seconds, 95), "max": max(seconds)}
+    return {
+        "rows": rows,
+        "shape": shape,
+        "output_mode": output_mode,
+        "runs": len(runs),
+        "wall_p50_seconds": percentile(wall, 50),
+        "wall_p95_seconds": percentile(wall, 95),
+        "rows_per_second": rows / percentile(wall, 50),
+        "peak_rss_mb": max(run["peak_rss_bytes"] for run in runs) / (1024 * 1024),
+        "ai_calls": runs[-1]["timings"].get("ai_calls", 0),
+        "prompt_tokens": runs[-1]["timings"].get("prompt_tokens", 0),
+        "stages": stages,
+    }
+
+
+def print_report(results: list):
+    print(f"{'rows':>8} {'shape':<7} {'output_mode':<26} {'p50 s':>8} {'p95 s':>8} {'rows/s':>10} {'peak MB':>8} {'calls':>6}")
+    for result in results:
+        print(f"{result['rows']:>8} {result['shape']:<7} {result['output_mode']:<26} {result['wall_p50_seconds']:>8.3f} "
+              f"{result['wall_p95_seconds']:>8.3f} {result['rows_per_second']:>10.0f} {result['peak_rss_mb']:>8.1f} {result['ai_calls']:>6}")
+        for stage, latency in result["stages"].items():
+            print(f"{'':>8} {'':<7}   {stage:<24} p50 {latency['p50']:.4f}s  p95 {latency['p95']:.4f}s  max {latency['max']:.4f}s")
+
+
+def compare_with_baseline(results: list, baseline_path: str, max_regression: float) -> list:
+    """Returns a description of every scenario whose p50 wall time regressed by more than max_regression against the baseline."""
+    with open(baseline_path) as f:
+        baseline = {(r["rows"], r["shape"], r["output_mode"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["rows"], result["shape"], result["output_mode"]))
+        if previous and result["wall_p50_seconds"] > previous["wall_p50_seconds"] * (1 + max_regression):
+            regressions.append(f"{result['rows']} rows {result['shape']} {result['output_mode']}: "
+                               f"{previous['wall_p50_seconds']:.3f}s -> {result['wall_p50_seconds']:.3f}s")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Xcelerate /upload pipeline.")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS), help="Data rows per synthetic sheet")
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES), help="Sheet widths to benchmark")
+    parser.add_argument("--output-modes", nargs="+", choices=OUTPUT_MODES, default=list(OUTPUT_MODES))
+    parser.add_argument("--command", default=DEFAULT_COMMAND, help="Command sent with every upload")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario")
+    parser.add_argument("--latency", type=float, default=StubGenerativeModel.latency_seconds, help="Stub latency per Gemini call, in seconds")
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.0, help="Additional stub latency per 1,000 prompt tokens, in seconds")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "xcelerate-benchmark"), help="Where synthetic workbooks are kept")
+    parser.add_argument("--json-out", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file from an earlier --json-out run")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed p50 slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's debug output")
+    args = parser.parse_args(argv)
+
+    StubGenerativeModel.latency_seconds = args.latency
+    StubGenerativeModel.latency_per_1k_tokens = args.latency_per_1k_tokens
+    xcelerate.genai.GenerativeModel = StubGenerativeModel
+    xcelerate.RESPONSE_CACHE_ENABLED = False
+    os.makedirs(args.work_dir, exist_ok=True)
+    workbook_paths = {(rows, shape): get_workbook(args.work_dir, rows, shape) for rows in args.rows for shape in args.shapes}
+    # The large synthetic workbooks exceed the default upload limit (MAX_UPLOAD_MB); leave room for the multipart overhead
+    largest_upload = max(os.path.getsize(path) for path in workbook_paths.values()) + 1024 * 1024
+    xcelerate.app.config['MAX_CONTENT_LENGTH'] = max(xcelerate.app.config['MAX_CONTENT_LENGTH'] or 0, largest_upload)
+    client = xcelerate.app.test_client()
+
+    results = []
+    for rows in args.rows:
+        for shape in args.shapes:
+            workbook_path = workbook_paths[(rows, shape)]
+            for output_mode in args.output_modes:
+                print(f"Running {rows} rows, {shape}, {output_mode} x{args.repeat} ...", file=sys.stderr)
+                runs = [run_once(client, workbook_path, output_mode, args.command, args.verbose) for _ in range(args.repeat)]
+                results.append(summarize(rows, shape, output_mode, runs))
+
+    print_report(results)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump({"latency_seconds": args.latency, "command": args.command, "results": results}, f, indent=2)
+
+    if args.compare:
+        regressions = compare_with_baseline(results, args.compare, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# backend/test_columns.py
+"""
+The streaming reader names columns with make_unique_column_names; the names must match the ones pandas gives the same
+header, since commands and results refer to columns by name whichever reader loaded the sheet.
+
+Run with: python -m pytest -q test_columns.py
+"""
+
+import io
+import random
+
+import pandas as pd
+import pytest
+
+import app as xcelerate
+
+HEADER_TOKENS = ["a", "a.1", "a.2", "a.1.1", "b", None, "", "  ", "Unnamed: 1", "Unnamed: 2", "Unnamed: 1.1"]
+
+
+def pandas_column_names(header_values: list) -> list:
+    csv_text = ",".join((value or "").strip() for value in header_values) + "\n" + ",".join("1" * len(header_values))
+    return list(pd.read_csv(io.StringIO(csv_text)).columns)
+
+
+@pytest.mark.parametrize("header_values, expected", [
+    (["a", "a", "a.1"], ["a", "a.2", "a.1"]),
+    (["a", "a.1", "a"], ["a", "a.1", "a.2"]),
+    (["x", None, "Unnamed: 1", "x"], ["x", "Unnamed: 1.1", "Unnamed: 1", "x.1"]),
+])
+def test_examples(header_values, expected):
+    assert xcelerate.make_unique_column_names(header_values) == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_pandas(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        header_values = [rng.choice(HEADER_TOKENS) for _ in range(rng.randint(1, 7))]
+        if all(value is None or not value.strip() for value in header_values):
+            continue
+        assert xcelerate.make_unique_column_names(header_values) == pandas_column_names(header_values), header_values
@@ -0,0 +1,88 @@
+# backend/test_parse.py
+"""
+Property test: the single-pass AI response parser (parse_ai_response_to_list and the incremental
+iter_parse_ai_response) must produce exactly the output of the original line-by-line parser, kept
+below as the reference, on random texts split into random chunks.
+
+Run with: python -m pytest -q test_parse.py
+"""
+
+import re
+import random
+
+import pytest
+
+import app as xcelerate
+
+
+def reference_parse_ai_response_to_list(ai_response_text: str) -> list:
+    """The original parse_ai_response_to_list, before it was rewritten around precompiled patterns."""
+    lines = ai_response_text.split('\n')
+    parsed_items = []
+
+    filter_keywords = [
+        "response:", "here is", "list below", "results:", "pure result list",
+        "could not generate a valid response", "no valid command", "error", "hint", "summary",
+        "this is about", "here's what you asked for", "based on your command", "okay", "please refer",
+        "provided for you below", "here is the de-duplicated list", "these are the extracted company names",
+        "here are the differences", "difference list below",
+        "hello", "this is your", "as per your request", "certainly"
+    ]
+
+    for line in lines:
+        stripped_line = line.strip()
+        if not stripped_line:
+            continue
+
+        is_potential_explanatory_line = any(keyword in stripped_line.lower() for keyword in filter_keywords)
+        if is_potential_explanatory_line and not stripped_line.startswith('*'):
+            continue
+
+        match = re.match(r'^\*\s*(.+)$', stripped_line)
+        if match:
+            item = match.group(1).strip()
+            item = re.sub(r'^\**', '', item)
+            item = re.sub(r'\**$', '', item)
+            item = re.sub(r'\s*\(\d+\)$', '', item).strip()
+            item = re.sub(r'^\d+\.?\s*\)?\s*', '', item).strip()
+
+            if item:
+                parsed_items.append(item)
+
+    return parsed_items
+
+
+# Building blocks that exercise every branch of the parser: list markers, bold markers, numbering,
+# trailing counts, filter keywords in mixed case and odd whitespace
+TOKENS = [
+    "* ", "*", "**", "***", " ", "  ", "\t", "\r", "\n", "\n", "\n", " ", "　",
+    "1.", "2)", "10. ", "3 )", "(4453)", " (12)", "(x)", "()", ".", ")", "(",
+    "Acme Corp", "Müller GmbH", "株式会社", "item", "N/A", "0", "42", "-", "|",
+    "Here is", "RESULTS:", "Error", "hint", "Summary", "okay", "Certainly", "hello", "response:",
+    "here's what you asked for", "As per your request", "list below", "errors", "ERROR:",
+]
+
+
+def random_response_text(rng: random.Random) -> str:
+    return "".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 60)))
+
+
+def random_chunks(rng: random.Random, text: str) -> list:
+    """Splits text at random positions (including empty chunks and splits inside line breaks)."""
+    cut_points = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, 8)))
+    return [text[start:end] for start, end in zip([0] + cut_points, cut_points + [len(text)])]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_parser_matches_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = random_response_text(rng)
+        expected = reference_parse_ai_response_to_list(text)
+        assert xcelerate.parse_ai_response_to_list(text) == expected, repr(text)
+        assert list(xcelerate.iter_parse_ai_response(random_chunks(rng, text))) == expected, repr(text)
+
+
+def test_typical_response():
+    text = "Here is the list:\n* **Acme Corp**\n* 2. Beta Ltd\n\n*   Gamma (12)\nSummary: 3 companies\n"
+    assert xcelerate.parse_ai_response_to_list(text) == reference_parse_ai_response_to_list(text) == ["Acme Corp", "Beta Ltd", "Gamma"]
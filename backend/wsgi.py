@@ -0,0 +1,13 @@
+# backend/wsgi.py
+"""
+Entry point for production WSGI servers, which import the app instead of running app.py:
+
+    gunicorn --chdir backend wsgi:app
+
+Importing this module starts the background services (job supervisor and storage janitor) that app.py
+only starts when it is run as the server itself.
+"""
+
+from app import app, start_background_services
+
+start_background_services()
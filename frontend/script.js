@@ -27,8 +27,11 @@ document.addEventListener('DOMContentLoaded', () => {
     const moonIcon = themeToggle ? themeToggle.querySelector('.fa-moon') : null;
 
 
-    // URL for the backend API
-    const API_URL = 'http://127.0.0.1:5000/upload';
+    // URL for the backend API (streams results as Server-Sent Events)
+    const API_URL = 'http://127.0.0.1:5000/upload_stream';
+    // Workbooks are uploaded once as a session; later commands on the same file only send the session id
+    const SESSIONS_URL = 'http://127.0.0.1:5000/sessions';
+    let uploadedSession = null; // { file, sessionId } of the most recently uploaded workbook
 
     // Helper function to get elements and check for null
     function getElement(id) {
@@ -122,6 +125,84 @@ document.addEventListener('DOMContentLoaded', () => {
         return tableHtml;
     }
 
+    // Display the data preview table and detected column names
+    function renderDataPreview(dataPreview) {
+        if (dataPreview && Array.isArray(dataPreview)) {
+            dataPreviewTableContainer.innerHTML = convertJsonToHtmlTable(dataPreview);
+
+            // Display detected column names
+            if (dataPreview.length > 0) {
+                const columnNames = Object.keys(dataPreview[0]);
+                columnNamesDiv.textContent = columnNames.join(', ');
+                columnNamesContainer.classList.remove('hidden');
+            } else {
+                columnNamesDiv.textContent = 'No column names detected (data preview is empty).';
+                columnNamesContainer.classList.remove('hidden');
+            }
+
+        } else {
+            dataPreviewTableContainer.innerHTML = '<p>No data preview available.</p>';
+            columnNamesDiv.textContent = 'No data preview, unable to detect column names.';
+            columnNamesContainer.classList.remove('hidden');
+        }
+    }
+
+    // Display the download button for the final result
+    function renderDownload(data) {
+        if (data.download_url) {
+            downloadLink.href = data.download_url;
+            downloadContainer.classList.remove('hidden');
+            // Ensure the download works by programmatically clicking an anchor tag
+            downloadLink.onclick = function(event) {
+                event.preventDefault(); // Prevent default link behavior
+                const tempLink = document.createElement('a');
+                tempLink.href = data.download_url;
+                tempLink.download = data.filename || 'processed_excel_results.xlsx'; // Fallback filename
+                document.body.appendChild(tempLink);
+                tempLink.click();
+                document.body.removeChild(tempLink);
+            };
+        } else {
+            downloadContainer.classList.add('hidden');
+        }
+    }
+
+    // Parse one Server-Sent Event block ("event: ...\ndata: ...") into { event, data }
+    function parseServerEvent(rawEvent) {
+        let event = 'message';
+        const dataLines = [];
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        return { event, data: dataLines.length > 0 ? JSON.parse(dataLines.join('\n')) : null };
+    }
+
+    // Upload the selected workbook as a session once and return its id (null if the upload failed)
+    async function getSessionId(file) {
+        if (uploadedSession && uploadedSession.file === file) {
+            return uploadedSession.sessionId;
+        }
+        const sessionData = new FormData();
+        sessionData.append('file', file);
+        try {
+            const response = await fetch(SESSIONS_URL, { method: 'POST', body: sessionData });
+            const data = await response.json();
+            if (!response.ok) {
+                console.warn(`Warning: Could not create workbook session: ${data.error}`);
+                return null;
+            }
+            uploadedSession = { file, sessionId: data.session_id };
+            return data.session_id;
+        } catch (error) {
+            console.warn('Warning: Could not create workbook session:', error);
+            return null;
+        }
+    }
+
     // Listen for changes in output mode selection
     if (outputModeSelect && newColumnNameInput) {
         outputModeSelect.addEventListener('change', () => {
@@ -231,8 +312,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
+            const sessionId = await getSessionId(file);
             const formData = new FormData();
-            formData.append('file', file);
+            if (sessionId) {
+                formData.append('session_id', sessionId);
+            } else {
+                formData.append('file', file); // Fall back to a plain upload if the session could not be created
+            }
             formData.append('command', command);
             formData.append('output_mode', outputMode); // Pass output mode to backend
             if (newColumnName) {
@@ -248,84 +334,71 @@ document.addEventListener('DOMContentLoaded', () => {
                     body: formData,
                 });
 
-                const responseText = await response.text();
-                console.log("DEBUG: Raw response text:", responseText);
-
-                let data;
-                try {
-                    // Try to find the start of a JSON object or array to handle potential extra logging from Flask
-                    const jsonStartIndex = responseText.indexOf('{');
-                    const arrayStartIndex = responseText.indexOf('[');
-
-                    let actualJsonString = responseText;
-                    if (jsonStartIndex !== -1 && (arrayStartIndex === -1 || jsonStartIndex < arrayStartIndex)) {
-                        actualJsonString = responseText.substring(jsonStartIndex);
-                    } else if (arrayStartIndex !== -1) {
-                        actualJsonString = responseText.substring(arrayStartIndex);
-                    } else {
-                        // If no JSON start character is found, the response might not be JSON, or it's malformed.
-                        // In this case, throw an error to be caught by the outer catch block.
-                        throw new Error("Could not find a valid JSON start character '{' or '[' in the response.");
-                    }
-
-                    data = JSON.parse(actualJsonString);
-                    console.log("DEBUG: Successfully parsed JSON data:", data);
-
-                } catch (jsonParseError) {
-                    console.error("JSON parsing failed, raw response text might be incorrect:", jsonParseError);
-                    showMessage('error', `Failed to parse server response: ${jsonParseError.message}. Raw response might be incorrect.`);
-                    loadingDiv.classList.add('hidden');
+                if (!response.ok || !response.body) {
+                    uploadedSession = null; // The session may have expired, so the next attempt uploads the file again
+                    // Validation errors are returned as plain JSON before streaming starts
+                    const data = await response.json().catch(() => ({}));
+                    showMessage('error', data.error || 'Upload failed, please try again later.');
                     return;
                 }
 
+                // Show results as they stream in: the preview first, then the AI list items as they are generated
+                resultDiv.classList.remove('hidden');
+                aiResponsePre.textContent = '';
+
+                // Streamed items are buffered and added to the page once per animation frame,
+                // so long lists do not rebuild the whole text for every item
+                let pendingItems = [];
+                let flushScheduled = false;
+                const flushPendingItems = () => {
+                    flushScheduled = false;
+                    if (pendingItems.length > 0) {
+                        aiResponsePre.appendChild(document.createTextNode(pendingItems.join('')));
+                        pendingItems = [];
+                    }
+                };
+                const appendStreamedItems = (values) => {
+                    for (const value of values) {
+                        pendingItems.push(`* ${value ?? ''}\n`);
+                    }
+                    if (!flushScheduled) {
+                        flushScheduled = true;
+                        requestAnimationFrame(flushPendingItems);
+                    }
+                };
 
-                if (response.ok) {
-                    showMessage('success', data.message);
-
-                    // Display data preview table
-                    if (data.data_preview && Array.isArray(data.data_preview)) {
-                        dataPreviewTableContainer.innerHTML = convertJsonToHtmlTable(data.data_preview);
-
-                        // Display detected column names
-                        if (data.data_preview.length > 0) {
-                            const columnNames = Object.keys(data.data_preview[0]);
-                            columnNamesDiv.textContent = columnNames.join(', ');
-                            columnNamesContainer.classList.remove('hidden');
-                        } else {
-                            columnNamesDiv.textContent = 'No column names detected (data preview is empty).';
-                            columnNamesContainer.classList.remove('hidden');
-                        }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
 
-                    } else {
-                        dataPreviewTableContainer.innerHTML = '<p>No data preview available.</p>';
-                        columnNamesDiv.textContent = 'No data preview, unable to detect column names.';
-                        columnNamesContainer.classList.remove('hidden');
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) {
+                        break;
                     }
-
-                    aiResponsePre.textContent = data.ai_response || "No AI response.";
-
-                    resultDiv.classList.remove('hidden');
-
-                    // Display download button
-                    if (data.download_url) {
-                        downloadLink.href = data.download_url;
-                        downloadContainer.classList.remove('hidden');
-                        // Ensure the download works by programmatically clicking an anchor tag
-                        downloadLink.onclick = function(event) {
-                            event.preventDefault(); // Prevent default link behavior
-                            const tempLink = document.createElement('a');
-                            tempLink.href = data.download_url;
-                            tempLink.download = data.filename || 'processed_excel_results.xlsx'; // Fallback filename
-                            document.body.appendChild(tempLink);
-                            tempLink.click();
-                            document.body.removeChild(tempLink);
-                        };
-                    } else {
-                        downloadContainer.classList.add('hidden');
+                    buffer += decoder.decode(value, { stream: true });
+
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                        const rawEvent = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        const { event, data } = parseServerEvent(rawEvent);
+
+                        if (event === 'preview') {
+                            renderDataPreview(data.data_preview);
+                        } else if (event === 'items') {
+                            appendStreamedItems(data.values); // Items as Gemini generates them, or a finished chunk of a large sheet
+                        } else if (event === 'done') {
+                            console.log("DEBUG: Streaming finished:", data);
+                            pendingItems = []; // The final response replaces the streamed items
+                            showMessage('success', data.message);
+                            renderDataPreview(data.data_preview);
+                            aiResponsePre.textContent = data.ai_response || "No AI response.";
+                            renderDownload(data);
+                        } else if (event === 'error') {
+                            showMessage('error', data.error || 'Processing failed, please try again later.');
+                        }
                     }
-
-                } else {
-                    showMessage('error', data.error || 'Upload failed, please try again later.');
                 }
             } catch (error) {
                 console.error('An error occurred during upload:', error);